@@ -0,0 +1,91 @@
+"""
+Data migrations for the PIOGOLD ICO backend.
+
+Usage:
+    python migrate.py backfill-ancestors
+    python migrate.py backfill-direct-referrals
+"""
+import argparse
+import asyncio
+
+from pymongo import UpdateOne
+
+from server import db, client, logger, REFERRAL_RATES
+
+BATCH_SIZE = 1000
+
+
+async def backfill_ancestors():
+    """Store each user's upline (ancestors: [level1, level2, level3])"""
+    referrer_of = {}
+    async for user in db.users.find({}, {"_id": 0, "id": 1, "referrer_id": 1}):
+        referrer_of[user["id"]] = user.get("referrer_id")
+
+    updates = []
+    updated = 0
+    for user_id in referrer_of:
+        ancestors = []
+        referrer_id = referrer_of[user_id]
+        while referrer_id and len(ancestors) < len(REFERRAL_RATES):
+            ancestors.append(referrer_id)
+            referrer_id = referrer_of.get(referrer_id)
+        updates.append(UpdateOne({"id": user_id}, {"$set": {"ancestors": ancestors}}))
+
+        if len(updates) >= BATCH_SIZE:
+            await db.users.bulk_write(updates, ordered=False)
+            updated += len(updates)
+            updates = []
+
+    if updates:
+        await db.users.bulk_write(updates, ordered=False)
+        updated += len(updates)
+    logger.info(f"Backfilled ancestors for {updated} users")
+
+
+async def backfill_direct_referrals():
+    """Store each user's direct referral count (direct_referrals)"""
+    counts = {}
+    async for doc in db.users.aggregate([
+        {"$match": {"referrer_id": {"$ne": None}}},
+        {"$group": {"_id": "$referrer_id", "count": {"$sum": 1}}}
+    ]):
+        counts[doc["_id"]] = doc["count"]
+
+    updates = []
+    updated = 0
+    async for user in db.users.find({}, {"_id": 0, "id": 1}):
+        updates.append(UpdateOne({"id": user["id"]}, {"$set": {"direct_referrals": counts.get(user["id"], 0)}}))
+
+        if len(updates) >= BATCH_SIZE:
+            await db.users.bulk_write(updates, ordered=False)
+            updated += len(updates)
+            updates = []
+
+    if updates:
+        await db.users.bulk_write(updates, ordered=False)
+        updated += len(updates)
+    logger.info(f"Backfilled direct referral counts for {updated} users")
+
+
+MIGRATIONS = {
+    "backfill-ancestors": backfill_ancestors,
+    "backfill-direct-referrals": backfill_direct_referrals,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a data migration")
+    parser.add_argument("migration", choices=sorted(MIGRATIONS))
+    args = parser.parse_args()
+
+    async def run():
+        try:
+            await MIGRATIONS[args.migration]()
+        finally:
+            client.close()
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
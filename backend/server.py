@@ -1,12 +1,17 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, BackgroundTasks
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Header, Query, Request, Response
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, IndexModel, ReturnDocument, UpdateMany, UpdateOne
+from pymongo import monitoring
+from pymongo.errors import DuplicateKeyError, OperationFailure
 import os
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field, ConfigDict, EmailStr
+from pydantic import BaseModel, Field, ConfigDict, EmailStr, field_validator
 from typing import List, Optional
 import uuid
 from datetime import datetime, timezone, timedelta
@@ -15,17 +20,246 @@ import bcrypt
 from Crypto.Cipher import AES
 from Crypto.Util.Padding import pad, unpad
 import base64
+import json
+import re
+import csv
+import io
 import hashlib
-from web3 import Web3
+import ipaddress
+from web3 import AsyncWeb3, AsyncHTTPProvider
+from web3.exceptions import TransactionNotFound
+from web3.middleware import Web3Middleware
+from eth_account import Account
 import httpx
+import aiohttp
 import asyncio
+import bisect
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from functools import wraps
+import contextvars
+import threading
+import time
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+# ==================== METRICS ====================
+
+FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+STAGE_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600)
+
+REQUEST_LATENCY = Histogram("pioico_http_request_duration_seconds", "HTTP request latency by route",
+                            ["method", "route", "status"])
+MONGO_LATENCY = Histogram("pioico_mongo_command_duration_seconds", "MongoDB command latency by collection",
+                          ["command", "collection", "outcome"], buckets=FAST_BUCKETS)
+RPC_LATENCY = Histogram("pioico_rpc_request_duration_seconds", "JSON-RPC latency by chain and method",
+                        ["chain", "method", "outcome"])
+OPERATION_LATENCY = Histogram("pioico_operation_duration_seconds", "Latency of instrumented hot-path functions",
+                              ["operation"])
+ORDER_STAGE_DURATION = Histogram("pioico_order_stage_duration_seconds",
+                                 "Time orders spend in each pipeline stage", ["stage"], buckets=STAGE_BUCKETS)
+PAYOUTS = Counter("pioico_payouts_total", "PIO payout outcomes", ["kind", "result"])
+QUEUE_DEPTH = Gauge("pioico_queue_depth", "Background work waiting to be processed", ["queue"])
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Times every command the Motor client sends; runs on the driver's threads"""
+
+    def __init__(self):
+        self.pending = {}
+
+    def started(self, event):
+        target = event.command.get(event.command_name)
+        if event.command_name == "getMore":
+            target = event.command.get("collection")
+        self.pending[(event.connection_id, event.request_id)] = target if isinstance(target, str) else ""
+
+    def _finish(self, event, outcome: str):
+        collection = self.pending.pop((event.connection_id, event.request_id), "")
+        MONGO_LATENCY.labels(event.command_name, collection, outcome).observe(event.duration_micros / 1e6)
+
+    def succeeded(self, event):
+        self._finish(event, "ok")
+
+    def failed(self, event):
+        self._finish(event, "error")
+
+class RPCMetricsMiddleware(Web3Middleware):
+    """web3 middleware timing each JSON-RPC call on one chain"""
+
+    chain = ""
+
+    @staticmethod
+    def build(chain: str):
+        def middleware(w3):
+            instance = RPCMetricsMiddleware(w3)
+            instance.chain = chain
+            return instance
+        return middleware
+
+    async def async_wrap_make_request(self, make_request):
+        async def middleware(method, params):
+            started = time.perf_counter()
+            outcome = "error"
+            try:
+                response = await make_request(method, params)
+                outcome = "error" if "error" in response else "ok"
+                return response
+            finally:
+                RPC_LATENCY.labels(self.chain, method, outcome).observe(time.perf_counter() - started)
+        return middleware
+
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', '100'))
+SLOW_QUERY_MAX_SHAPES = int(os.environ.get('SLOW_QUERY_MAX_SHAPES', '1000'))
+QUERY_COMMANDS = {"find", "aggregate", "count", "distinct", "findAndModify", "update", "delete", "insert", "getMore"}
+EXPLAINABLE_COMMANDS = {"find", "aggregate", "count", "distinct"}
+UNSENT_COMMAND_FIELDS = {"lsid", "txnNumber", "readConcern", "writeConcern", "cursor", "batchSize",
+                         "singleBatch", "maxTimeMS", "comment"}
+
+# Where a command came from: "GET /api/..." for requests, a worker name for background tasks.
+# Motor runs each operation in a copy of the caller's context, so listeners can read it.
+current_route = contextvars.ContextVar("current_route", default="unknown")
+
+def redact(value):
+    """Keep a filter's field names and operators, replace every value with '?'"""
+    if isinstance(value, dict):
+        return {key: redact(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [redact(item) for item in value[:1]]
+    return "?"
+
+def query_shape(command_name: str, command: dict) -> dict:
+    if command_name == "find":
+        return {"filter": redact(command.get("filter", {})), "sort": command.get("sort")}
+    if command_name == "aggregate":
+        return {"pipeline": redact(command.get("pipeline", []))}
+    if command_name in ("count", "distinct", "findAndModify"):
+        return {"query": redact(command.get("query", {})), "key": command.get("key"), "sort": command.get("sort")}
+    if command_name in ("update", "delete"):
+        statements = command.get(command_name + "s") or [{}]
+        return {"q": redact(statements[0].get("q", {}))}
+    return {}
+
+class SlowQueryMonitor(monitoring.CommandListener):
+    """Aggregates command timings per redacted query shape and explains slow reads once per shape"""
+
+    def __init__(self):
+        self.pending = {}
+        self.shapes = {}
+        self.lock = threading.Lock()
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.explain_tasks = set()
+
+    def started(self, event):
+        if event.command_name in QUERY_COMMANDS:
+            self.pending[(event.connection_id, event.request_id)] = (event.command, current_route.get())
+
+    def succeeded(self, event):
+        entry = self.pending.pop((event.connection_id, event.request_id), None)
+        if entry is not None:
+            self.record(event, *entry)
+
+    def failed(self, event):
+        self.pending.pop((event.connection_id, event.request_id), None)
+
+    def record(self, event, command: dict, route: str):
+        name = event.command_name
+        collection = command.get("collection") if name == "getMore" else command.get(name)
+        shape = query_shape(name, command)
+        key = json.dumps([event.database_name, collection, name, shape], sort_keys=True, default=str)
+        ms = event.duration_micros / 1000
+        slow = ms >= SLOW_QUERY_MS
+        with self.lock:
+            stats = self.shapes.get(key)
+            if stats is None:
+                if len(self.shapes) >= SLOW_QUERY_MAX_SHAPES:
+                    return
+                stats = self.shapes[key] = {
+                    "collection": collection, "command": name, "shape": shape, "count": 0, "total_ms": 0.0,
+                    "max_ms": 0.0, "slow_count": 0, "routes": {}, "docs_examined": None, "keys_examined": None,
+                    "returned": None, "plan": None, "explained": False
+                }
+            stats["count"] += 1
+            stats["total_ms"] += ms
+            stats["max_ms"] = max(stats["max_ms"], ms)
+            if route in stats["routes"] or len(stats["routes"]) < 20:
+                stats["routes"][route] = stats["routes"].get(route, 0) + 1
+            explain = slow and not stats["explained"] and name in EXPLAINABLE_COMMANDS and self.loop is not None
+            if slow:
+                stats["slow_count"] += 1
+            if explain:
+                stats["explained"] = True
+        if slow:
+            logger.warning(f"Slow query {ms:.0f}ms {name} {collection} from {route}: {json.dumps(shape, default=str)}")
+        if explain and not any("$out" in stage or "$merge" in stage for stage in command.get("pipeline", [])):
+            self.loop.call_soon_threadsafe(self.start_explain, key, event.database_name, command)
+
+    def start_explain(self, key: str, database: str, command: dict):
+        task = asyncio.create_task(self.explain(key, database, command))
+        self.explain_tasks.add(task)
+        task.add_done_callback(self.explain_tasks.discard)
+
+    async def explain(self, key: str, database: str, command: dict):
+        """Run the slow command once under explain to learn how many documents it had to read"""
+        explained = {k: v for k, v in command.items() if not k.startswith("$") and k not in UNSENT_COMMAND_FIELDS}
+        if "aggregate" in explained:
+            explained["cursor"] = {}
+        try:
+            result = await client[database].command({"explain": explained, "verbosity": "executionStats"})
+        except Exception as e:
+            logger.info(f"Could not explain slow query: {e}")
+            return
+        execution = result.get("executionStats") or {}
+        if not execution:
+            # Aggregations report per-stage stats; the first $cursor stage holds the query's
+            for stage in result.get("stages", []):
+                execution = stage.get("$cursor", {}).get("executionStats") or {}
+                if execution:
+                    break
+        plan = json.dumps(result.get("queryPlanner") or result.get("stages") or {}, default=str)
+        with self.lock:
+            stats = self.shapes.get(key)
+            if stats is not None:
+                stats["docs_examined"] = execution.get("totalDocsExamined")
+                stats["keys_examined"] = execution.get("totalKeysExamined")
+                stats["returned"] = execution.get("nReturned")
+                stats["plan"] = "COLLSCAN" if "COLLSCAN" in plan else "IXSCAN" if "IXSCAN" in plan else None
+        if "COLLSCAN" in plan:
+            logger.warning(f"Slow query on {json.loads(key)[1]} is a collection scan: {json.loads(key)[3]}")
+
+    def top(self, limit: int, order_by: str) -> list:
+        with self.lock:
+            rows = [
+                {**stats, "routes": dict(stats["routes"]), "avg_ms": round(stats["total_ms"] / stats["count"], 2),
+                 "total_ms": round(stats["total_ms"], 2), "max_ms": round(stats["max_ms"], 2)}
+                for stats in self.shapes.values()
+            ]
+        rows.sort(key=lambda row: row[order_by], reverse=True)
+        return rows[:limit]
+
+    def reset(self):
+        with self.lock:
+            self.shapes.clear()
+
+slow_query_monitor = SlowQueryMonitor()
+
+def timed(operation: str):
+    """Record an async function's duration in pioico_operation_duration_seconds"""
+    def decorator(fn):
+        @wraps(fn)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                OPERATION_LATENCY.labels(operation).observe(time.perf_counter() - started)
+        return wrapper
+    return decorator
+
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(mongo_url, event_listeners=[MongoCommandMetrics(), slow_query_monitor])
 db = client[os.environ['DB_NAME']]
 
 # Create the main app
@@ -43,12 +277,23 @@ JWT_ALGORITHM = 'HS256'
 BSC_RPC = "https://bsc-dataseed.binance.org"
 PIOGOLD_RPC = "https://datasheed.pioscan.com"
 USDT_CONTRACT = "0x55d398326f99059fF775485246999027B3197955"
+USDT_DECIMALS = 18
+# keccak256("Transfer(address,address,uint256)")
+TRANSFER_EVENT_TOPIC = "0xddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef"
 PIOGOLD_CHAIN_ID = 42357
 BSC_CHAIN_ID = 56
 
-# Web3 instances
-bsc_w3 = Web3(Web3.HTTPProvider(BSC_RPC))
-piogold_w3 = Web3(Web3.HTTPProvider(PIOGOLD_RPC))
+# RPC connection pool
+RPC_TIMEOUT = float(os.environ.get('RPC_TIMEOUT', '10'))  # seconds per JSON-RPC call
+RPC_POOL_SIZE = int(os.environ.get('RPC_POOL_SIZE', '100'))
+RPC_KEEPALIVE = float(os.environ.get('RPC_KEEPALIVE', '30'))
+
+# Web3 instances (non-blocking; they share one pooled aiohttp session opened at startup)
+bsc_w3 = AsyncWeb3(AsyncHTTPProvider(BSC_RPC, request_kwargs={"timeout": aiohttp.ClientTimeout(total=RPC_TIMEOUT)}))
+piogold_w3 = AsyncWeb3(AsyncHTTPProvider(PIOGOLD_RPC, request_kwargs={"timeout": aiohttp.ClientTimeout(total=RPC_TIMEOUT)}))
+bsc_w3.middleware_onion.add(RPCMetricsMiddleware.build("bsc"), "rpc_metrics")
+piogold_w3.middleware_onion.add(RPCMetricsMiddleware.build("piogold"), "rpc_metrics")
+rpc_session: Optional[aiohttp.ClientSession] = None
 
 # AES Encryption key (32 bytes for AES-256)
 AES_KEY = hashlib.sha256(os.environ.get('AES_SECRET', 'piogold-aes-256-encryption-key').encode()).digest()
@@ -108,11 +353,21 @@ class OfferResponse(BaseModel):
     is_active: bool
     created_at: str
 
+TX_HASH_PATTERN = re.compile(r"0x[0-9a-fA-F]{64}")
+
 class OrderCreate(BaseModel):
     wallet_address: str
     usdt_amount: float
     tx_hash: str
 
+    @field_validator("tx_hash")
+    @classmethod
+    def normalize_tx_hash(cls, value: str) -> str:
+        # The unique usdt_tx_hash index is case-sensitive; one transfer must map to one key
+        if not TX_HASH_PATTERN.fullmatch(value):
+            raise ValueError("tx_hash must be 0x followed by 64 hex characters")
+        return value.lower()
+
 class OrderResponse(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str
@@ -183,9 +438,21 @@ class PurchaseCalculationResponse(BaseModel):
     total_pio: float
     discount_tier: Optional[str] = None
 
+MAX_BATCH_QUOTES = int(os.environ.get('MAX_BATCH_QUOTES', '5000'))
+
+class PurchaseCalculationBatch(BaseModel):
+    usdt_amounts: List[float] = Field(..., min_length=1, max_length=MAX_BATCH_QUOTES)
+
 class ReferralPayoutUpdate(BaseModel):
     status: str  # "approved" or "paid"
 
+class ReferralBulkPayout(BaseModel):
+    status: str = "approved"  # "pending" or "approved"
+    referrer_id: Optional[str] = None
+    created_from: Optional[str] = None
+    created_to: Optional[str] = None
+    dry_run: bool = False
+
 class TeamMemberCreate(BaseModel):
     role: str  # CEO, CFO, COO, Marketing Head
     name: str
@@ -214,6 +481,267 @@ class LegalDocumentResponse(BaseModel):
     is_active: bool
     updated_at: str
 
+# ==================== INDEXES ====================
+
+# Indexes the handlers rely on. Unique ones back correctness (dedupe and
+# idempotent upserts), so startup aborts if any of them cannot be built.
+REQUIRED_INDEXES = {
+    "users": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("wallet_address", ASCENDING)], name="wallet_address_unique", unique=True),
+        IndexModel([("referral_code", ASCENDING)], name="referral_code_unique", unique=True),
+        IndexModel([("referrer_id", ASCENDING)], name="referrer_id"),
+        IndexModel([("ancestors", ASCENDING), ("created_at", DESCENDING)], name="ancestors_created_at"),
+        IndexModel([("created_at", DESCENDING), ("id", DESCENDING)], name="created_at_id"),
+        IndexModel([("direct_referrals", DESCENDING), ("id", DESCENDING)], name="direct_referrals_id"),
+        IndexModel([("total_purchased_usdt", DESCENDING), ("id", DESCENDING)], name="total_purchased_usdt_id"),
+    ],
+    "orders": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("usdt_tx_hash", ASCENDING)], name="usdt_tx_hash_unique", unique=True),
+        IndexModel([("idempotency_key", ASCENDING)], name="idempotency_key_unique", unique=True, sparse=True),
+        IndexModel([("wallet_address", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)], name="wallet_address_created_at_id"),
+        IndexModel([("user_id", ASCENDING), ("created_at", DESCENDING)], name="user_id_created_at"),
+        IndexModel([("status", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)], name="status_created_at_id"),
+        IndexModel([("created_at", DESCENDING), ("id", DESCENDING)], name="created_at_id"),
+        IndexModel([("pio_tx_hash", ASCENDING)], name="pio_tx_hash", sparse=True),
+    ],
+    "referrals": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("referrer_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)], name="referrer_id_created_at_id"),
+        IndexModel([("payout_batch", ASCENDING), ("referrer_id", ASCENDING)], name="payout_batch_referrer_id", sparse=True),
+        IndexModel([("status", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)], name="status_created_at_id"),
+        IndexModel([("created_at", DESCENDING), ("id", DESCENDING)], name="created_at_id"),
+    ],
+    "transactions": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("order_id", ASCENDING), ("type", ASCENDING)], name="order_id_type"),
+        IndexModel([("tx_hash", ASCENDING)], name="tx_hash"),
+        IndexModel([("chain", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)], name="chain_created_at_id"),
+        IndexModel([("from_address", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)], name="from_address_created_at_id"),
+        IndexModel([("to_address", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)], name="to_address_created_at_id"),
+        IndexModel([("created_at", DESCENDING), ("id", DESCENDING)], name="created_at_id"),
+    ],
+    "usdt_payments": [
+        IndexModel([("tx_hash", ASCENDING), ("log_index", ASCENDING)], name="tx_hash_log_index_unique", unique=True),
+    ],
+    "jobs": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("status", ASCENDING), ("run_at", ASCENDING)], name="status_run_at"),
+        IndexModel([("status", ASCENDING), ("lease_until", ASCENDING)], name="status_lease_until"),
+    ],
+    "payouts": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("status", ASCENDING), ("nonce", ASCENDING)], name="status_nonce"),
+        IndexModel([("reference", ASCENDING), ("kind", ASCENDING)], name="reference_kind_active_unique", unique=True,
+                   partialFilterExpression={"active": True, "reference": {"$type": "string"}}),
+    ],
+    "offers": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+    ],
+    "admins": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("username", ASCENDING)], name="username_unique", unique=True),
+    ],
+    "login_attempts": [
+        IndexModel([("expires_at", ASCENDING)], name="expires_at_ttl", expireAfterSeconds=0),
+    ],
+    "revoked_tokens": [
+        IndexModel([("jti", ASCENDING)], name="jti_unique", unique=True),
+        IndexModel([("expires_at", ASCENDING)], name="expires_at_ttl", expireAfterSeconds=0),
+    ],
+}
+
+async def ensure_indexes():
+    """Create the declared indexes; existing ones are left untouched"""
+    for collection_name, models in REQUIRED_INDEXES.items():
+        for model in models:
+            spec = model.document
+            try:
+                await db[collection_name].create_indexes([model])
+            except OperationFailure as e:
+                if spec.get("unique"):
+                    raise RuntimeError(
+                        f"Cannot build required unique index {collection_name}.{spec['name']}: {e}"
+                    ) from e
+                logger.error(f"Index {collection_name}.{spec['name']} could not be created: {e}")
+    logger.info("Index bootstrap complete")
+
+async def get_index_report() -> dict:
+    """Declared indexes that are missing, and existing ones with no recorded use since server start"""
+    report = {}
+    for collection_name, models in REQUIRED_INDEXES.items():
+        collection = db[collection_name]
+        existing = await collection.index_information()
+        existing_keys = {tuple(info["key"]) for info in existing.values()}
+        missing = [
+            model.document["name"] for model in models
+            if tuple(model.document["key"].items()) not in existing_keys
+        ]
+        unused = []
+        try:
+            async for stat in collection.aggregate([{"$indexStats": {}}]):
+                if stat["name"] != "_id_" and stat["accesses"]["ops"] == 0:
+                    unused.append(stat["name"])
+        except OperationFailure:
+            pass
+        report[collection_name] = {"existing": sorted(existing), "missing": missing, "unused": unused}
+    return report
+
+# ==================== CACHES ====================
+
+# Seconds between cache version polls when MongoDB change streams are unavailable
+CACHE_SYNC_INTERVAL = float(os.environ.get('CACHE_SYNC_INTERVAL', '5'))
+PUBLIC_CACHE_MAX_AGE = int(os.environ.get('PUBLIC_CACHE_MAX_AGE', '60'))
+
+class VersionedCache:
+    """In-memory copy of rarely-changing data.
+
+    Local writes invalidate it directly; writes made by other workers are
+    picked up through the shared counter in the cache_versions collection.
+    """
+
+    def __init__(self, name: str, loader):
+        self.name = name
+        self.loader = loader
+        self.value = None
+        self.loaded = False
+        self.version = None  # last shared version seen by this worker
+        self.generation = 0  # bumped on invalidation so in-flight loads are discarded
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._lock = asyncio.Lock()
+
+    async def get(self):
+        if self.loaded:
+            self.hits += 1
+            return self.value
+        async with self._lock:
+            if self.loaded:
+                self.hits += 1
+                return self.value
+            self.misses += 1
+            generation = self.generation
+            value = await self.loader()
+            if generation == self.generation:
+                self.value = value
+                self.loaded = True
+            return value
+
+    def invalidate(self):
+        self.generation += 1
+        self.loaded = False
+        self.value = None
+        self.invalidations += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0,
+            "invalidations": self.invalidations,
+            "version": self.version,
+            "loaded": self.loaded
+        }
+
+CACHES = {}
+
+def register_cache(name: str, loader) -> VersionedCache:
+    cache = VersionedCache(name, loader)
+    CACHES[name] = cache
+    return cache
+
+async def invalidate_cache(cache: VersionedCache):
+    """Drop the local copy and bump the shared version so other workers reload too"""
+    cache.invalidate()
+    doc = await db.cache_versions.find_one_and_update(
+        {"_id": cache.name},
+        {"$inc": {"version": 1}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    cache.version = doc["version"]
+
+def _apply_cache_version(name: str, version):
+    cache = CACHES.get(name)
+    if cache is None:
+        return
+    if cache.version != version:
+        cache.invalidate()
+        cache.version = version
+
+async def poll_cache_versions():
+    async for doc in db.cache_versions.find({}):
+        _apply_cache_version(doc["_id"], doc.get("version"))
+
+async def sync_cache_versions():
+    """Invalidate local caches when another worker bumps a cache version"""
+    use_change_stream = True
+    while True:
+        try:
+            if use_change_stream:
+                async with db.cache_versions.watch(full_document="updateLookup") as stream:
+                    # Catch up on anything bumped before the stream was opened
+                    await poll_cache_versions()
+                    async for change in stream:
+                        doc = change.get("fullDocument") or {}
+                        _apply_cache_version(change["documentKey"]["_id"], doc.get("version"))
+            else:
+                await poll_cache_versions()
+                await asyncio.sleep(CACHE_SYNC_INTERVAL)
+        except OperationFailure as e:
+            if use_change_stream:
+                # Change streams require a replica set; fall back to polling the counters
+                logger.info(f"Change streams unavailable ({e}), polling cache versions every {CACHE_SYNC_INTERVAL}s")
+                use_change_stream = False
+            else:
+                logger.error(f"Cache version sync error: {e}")
+                await asyncio.sleep(CACHE_SYNC_INTERVAL)
+        except Exception as e:
+            logger.error(f"Cache version sync error: {e}")
+            await asyncio.sleep(CACHE_SYNC_INTERVAL)
+
+class ResponseCache:
+    """Serialized JSON bodies built from versioned caches, rebuilt only when one of them is invalidated"""
+
+    def __init__(self, *sources: VersionedCache):
+        self.sources = sources
+        self.entries = {}
+        self.hits = 0
+        self.builds = 0
+
+    async def get(self, key, build) -> tuple:
+        stamp = tuple(source.generation for source in self.sources)
+        entry = self.entries.get(key)
+        if entry and entry[0] == stamp:
+            self.hits += 1
+            return entry[1:]
+        self.builds += 1
+        body = json.dumps(jsonable_encoder(await build()), separators=(",", ":")).encode()
+        # Content-derived, so every worker hands out the same ETag for the same body
+        etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+        modified = datetime.now(timezone.utc).strftime("%a, %d %b %Y %H:%M:%S GMT")
+        self.entries = {k: e for k, e in self.entries.items() if e[0] == stamp}
+        self.entries[key] = (stamp, body, etag, modified)
+        return body, etag, modified
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "builds": self.builds, "entries": len(self.entries)}
+
+def cached_json_response(request: Request, body: bytes, etag: str, modified: str) -> Response:
+    """Answer with 304 when the client already holds this body, otherwise send it with validators"""
+    headers = {"ETag": etag, "Last-Modified": modified, "Cache-Control": f"public, max-age={PUBLIC_CACHE_MAX_AGE}"}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        if etag in tags or "*" in tags:
+            return Response(status_code=304, headers=headers)
+    elif request.headers.get("if-modified-since") == modified:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
 # ==================== HELPER FUNCTIONS ====================
 
 def encrypt_private_key(private_key: str) -> str:
@@ -241,36 +769,236 @@ def generate_referral_code() -> str:
     """Generate unique referral code"""
     return str(uuid.uuid4())[:8].upper()
 
-def hash_password(password: str) -> str:
+PASSWORD_WORKERS = int(os.environ.get('PASSWORD_WORKERS', '2'))
+PASSWORD_MAX_WAITING = int(os.environ.get('PASSWORD_MAX_WAITING', '20'))  # queued hash jobs before shedding load
+LOGIN_WINDOW = int(os.environ.get('LOGIN_WINDOW', '300'))
+LOGIN_MAX_ATTEMPTS_PER_USER = int(os.environ.get('LOGIN_MAX_ATTEMPTS_PER_USER', '5'))
+LOGIN_MAX_ATTEMPTS_PER_IP = int(os.environ.get('LOGIN_MAX_ATTEMPTS_PER_IP', '20'))
+# Only enable behind a reverse proxy that sets X-Real-IP; otherwise clients could pick their own address
+TRUST_PROXY_HEADERS = os.environ.get('TRUST_PROXY_HEADERS', 'false').lower() == 'true'
+TRUSTED_PROXIES = [
+    ipaddress.ip_network(entry.strip())
+    for entry in os.environ.get('TRUSTED_PROXIES', '127.0.0.1,::1').split(',') if entry.strip()
+]
+
+# bcrypt releases the GIL, so a small thread pool keeps it off the event loop
+password_executor = ThreadPoolExecutor(max_workers=PASSWORD_WORKERS, thread_name_prefix="bcrypt")
+password_slots = asyncio.Semaphore(PASSWORD_WORKERS)
+password_pool = {"workers": PASSWORD_WORKERS, "running": 0, "waiting": 0, "shed": 0, "throttled": 0}
+
+async def run_password_op(fn, *args):
+    """Run a bcrypt call in the pool, refusing new work once too many are already queued"""
+    if password_pool["waiting"] >= PASSWORD_MAX_WAITING:
+        password_pool["shed"] += 1
+        raise HTTPException(status_code=503, detail="Too many login attempts in progress, try again shortly")
+    password_pool["waiting"] += 1
+    try:
+        await password_slots.acquire()
+    finally:
+        password_pool["waiting"] -= 1
+    password_pool["running"] += 1
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(password_executor, fn, *args)
+    finally:
+        password_pool["running"] -= 1
+        password_slots.release()
+
+def _hash_password(password: str) -> str:
     return bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
 
-def verify_password(password: str, hashed: str) -> bool:
+def _verify_password(password: str, hashed: str) -> bool:
     return bcrypt.checkpw(password.encode(), hashed.encode())
 
+async def hash_password(password: str) -> str:
+    return await run_password_op(_hash_password, password)
+
+async def verify_password(password: str, hashed: str) -> bool:
+    return await run_password_op(_verify_password, password, hashed)
+
+def is_trusted_proxy(host: str) -> bool:
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return any(address in network for network in TRUSTED_PROXIES)
+
+def client_ip(request: Request) -> str:
+    peer = request.client.host if request.client else None
+    if TRUST_PROXY_HEADERS and peer and is_trusted_proxy(peer) and request.headers.get("x-real-ip"):
+        return request.headers["x-real-ip"]
+    return peer or "unknown"
+
+async def count_login_attempt(key: str, window: int) -> int:
+    doc = await db.login_attempts.find_one_and_update(
+        {"_id": f"{key}:{window}"},
+        {"$inc": {"count": 1},
+         "$setOnInsert": {"expires_at": datetime.fromtimestamp((window + 1) * LOGIN_WINDOW, timezone.utc)}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    return doc["count"]
+
+async def throttle_login(username: str, ip: str):
+    """Count this attempt against the username and the client IP; 429 once either is over its limit"""
+    now = datetime.now(timezone.utc).timestamp()
+    window = int(now // LOGIN_WINDOW)
+    user_attempts, ip_attempts = await asyncio.gather(
+        count_login_attempt(f"user:{username.lower()}", window),
+        count_login_attempt(f"ip:{ip}", window)
+    )
+    if user_attempts > LOGIN_MAX_ATTEMPTS_PER_USER or ip_attempts > LOGIN_MAX_ATTEMPTS_PER_IP:
+        password_pool["throttled"] += 1
+        retry_after = int((window + 1) * LOGIN_WINDOW - now) + 1
+        raise HTTPException(status_code=429, detail="Too many login attempts",
+                            headers={"Retry-After": str(retry_after)})
+
 def create_token(data: dict, expires_delta: timedelta = timedelta(hours=24)) -> str:
     to_encode = data.copy()
     expire = datetime.now(timezone.utc) + expires_delta
-    to_encode.update({"exp": expire})
+    to_encode.update({"exp": expire, "jti": uuid.uuid4().hex})
     return jwt.encode(to_encode, JWT_SECRET, algorithm=JWT_ALGORITHM)
 
-async def get_current_admin(credentials: HTTPAuthorizationCredentials = Depends(security)):
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', '1000'))
+
+def encode_cursor(values: list) -> str:
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+def decode_cursor(cursor: str) -> list:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not isinstance(values, list) or len(values) != 2:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return values
+
+def keyset_filter(sort_field: str, cursor: str, descending: bool = True) -> dict:
+    """Query for the rows after a cursor in (sort_field, id) order"""
+    value, last_id = decode_cursor(cursor)
+    op = "$lt" if descending else "$gt"
+    return {"$or": [{sort_field: {op: value}}, {sort_field: value, "id": {op: last_id}}]}
+
+async def find_page(collection, query: dict, sort_field: str, limit: int, response: Response,
+                    cursor: Optional[str] = None, descending: bool = True, projection: Optional[dict] = None) -> list:
+    """Fetch one keyset-paginated page; the cursor for the next page goes in the X-Next-Cursor header"""
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {MAX_PAGE_SIZE}")
+    if cursor:
+        query = {"$and": [query, keyset_filter(sort_field, cursor, descending)]}
+    direction = -1 if descending else 1
+    rows = await collection.find(query, projection or {"_id": 0}).sort(
+        [(sort_field, direction), ("id", direction)]
+    ).limit(limit + 1).to_list(limit + 1)
+    if len(rows) > limit:
+        rows = rows[:limit]
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor([rows[-1].get(sort_field), rows[-1]["id"]])
+    return rows
+
+FIELD_NAME = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+def parse_projection(fields: Optional[str]) -> Optional[dict]:
+    """Turn a comma-separated field list into a projection; id and created_at are kept for the cursor"""
+    if not fields:
+        return None
+    names = {name.strip() for name in fields.split(",") if name.strip()}
+    if not all(FIELD_NAME.match(name) for name in names):
+        raise HTTPException(status_code=400, detail="Invalid fields")
+    return {"_id": 0, "id": 1, "created_at": 1, **{name: 1 for name in names}}
+
+def range_filter(query: dict, field: str, low=None, high=None):
+    """Add an inclusive [low, high] bound on field to query, skipping unset ends"""
+    bounds = {}
+    if low is not None:
+        bounds["$gte"] = low
+    if high is not None:
+        bounds["$lte"] = high
+    if bounds:
+        query[field] = bounds
+
+ADMIN_CACHE_TTL = float(os.environ.get('ADMIN_CACHE_TTL', '60'))
+
+async def _load_revoked_tokens():
+    now = datetime.now(timezone.utc)
+    return {doc["jti"] async for doc in db.revoked_tokens.find({"expires_at": {"$gt": now}}, {"_id": 0, "jti": 1})}
+
+revoked_tokens_cache = register_cache("revoked_tokens", _load_revoked_tokens)
+
+class AdminPrincipalCache:
+    """Admin records by token subject, reused for ADMIN_CACHE_TTL seconds"""
+
+    def __init__(self):
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, admin_id: str) -> Optional[dict]:
+        loop_time = asyncio.get_running_loop().time()
+        entry = self.entries.get(admin_id)
+        if entry and entry[1] > loop_time:
+            self.hits += 1
+            return entry[0]
+        self.misses += 1
+        admin = await db.admins.find_one({"id": admin_id}, {"_id": 0, "password_hash": 0})
+        if admin:
+            self.entries[admin_id] = (admin, loop_time + ADMIN_CACHE_TTL)
+        else:
+            self.entries.pop(admin_id, None)
+        return admin
+
+    def invalidate(self, admin_id: str):
+        self.entries.pop(admin_id, None)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0,
+            "cached": len(self.entries)
+        }
+
+admin_principals = AdminPrincipalCache()
+
+async def revoke_token(payload: dict):
+    """Reject a token from now on, on every worker, until it would have expired anyway"""
+    await db.revoked_tokens.update_one(
+        {"jti": payload["jti"]},
+        {"$setOnInsert": {
+            "jti": payload["jti"],
+            "admin_id": payload.get("sub"),
+            "expires_at": datetime.fromtimestamp(payload["exp"], timezone.utc),
+            "revoked_at": datetime.now(timezone.utc).isoformat()
+        }},
+        upsert=True
+    )
+    await invalidate_cache(revoked_tokens_cache)
+    admin_principals.invalidate(payload.get("sub"))
+
+def decode_admin_token(credentials: Optional[HTTPAuthorizationCredentials]) -> dict:
     if not credentials:
         raise HTTPException(status_code=401, detail="Not authenticated")
     try:
         payload = jwt.decode(credentials.credentials, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-        admin_id = payload.get("sub")
-        if admin_id is None:
-            raise HTTPException(status_code=401, detail="Invalid token")
-        admin = await db.admins.find_one({"id": admin_id}, {"_id": 0})
-        if not admin:
-            raise HTTPException(status_code=401, detail="Admin not found")
-        return admin
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token expired")
     except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Invalid token")
+    if payload.get("sub") is None:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    return payload
 
-async def get_admin_settings():
+async def get_current_admin(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    payload = decode_admin_token(credentials)
+    if payload.get("jti") in await revoked_tokens_cache.get():
+        raise HTTPException(status_code=401, detail="Token revoked")
+    admin = await admin_principals.get(payload["sub"])
+    if not admin:
+        raise HTTPException(status_code=401, detail="Admin not found")
+    return admin
+
+async def _load_admin_settings():
     settings = await db.admin_settings.find_one({}, {"_id": 0})
     if not settings:
         # Initialize default settings
@@ -286,39 +1014,115 @@ async def get_admin_settings():
             "updated_at": datetime.now(timezone.utc).isoformat()
         }
         await db.admin_settings.insert_one(settings)
+        settings.pop("_id", None)
     return settings
 
+settings_cache = register_cache("settings", _load_admin_settings)
+
+async def get_admin_settings():
+    """Get admin settings, served from the in-memory settings cache"""
+    return dict(await settings_cache.get())
+
+def parse_iso_datetime(value: str) -> datetime:
+    return datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+class DiscountIndex:
+    """Active offers compiled into sorted amount boundaries.
+
+    Tiers are kept in the same precedence as the old linear scan (highest
+    min_usdt first), and each tier's validity window is turned into an
+    absolute cutoff so a lookup is a bisect plus a datetime comparison.
+    """
+
+    def __init__(self, offers: list, ico_start_date: str):
+        self.offers = offers
+        self.ico_start_date = ico_start_date
+        ico_start = parse_iso_datetime(ico_start_date)
+
+        tiers = []
+        for offer in sorted(offers, key=lambda o: o["min_usdt"], reverse=True):
+            # (now - ico_start).days <= validity_days holds until validity_days + 1 whole days have passed
+            cutoff = ico_start + timedelta(days=offer["validity_days"] + 1)
+            label = f"${offer['min_usdt']}-${offer['max_usdt']} ({offer['discount_percent']}% bonus)"
+            tiers.append((offer["min_usdt"], offer["max_usdt"], cutoff, offer["discount_percent"], label))
+
+        self.tier_count = len(tiers)
+        self.points = sorted({bound for tier in tiers for bound in tier[:2]})
+        # Candidate tiers at each boundary and inside each open gap between neighbouring boundaries
+        self.at_point = [[t for t in tiers if t[0] <= p <= t[1]] for p in self.points]
+        self.between = [
+            [t for t in tiers if t[0] <= lo and hi <= t[1]]
+            for lo, hi in zip(self.points, self.points[1:])
+        ]
+
+    def candidates(self, usdt_amount: float) -> list:
+        i = bisect.bisect_left(self.points, usdt_amount)
+        if i < len(self.points) and self.points[i] == usdt_amount:
+            return self.at_point[i]
+        if 0 < i < len(self.points):
+            return self.between[i - 1]
+        return []
+
+    def lookup(self, usdt_amount: float, now: datetime) -> tuple:
+        for _, _, cutoff, discount_percent, label in self.candidates(usdt_amount):
+            if now < cutoff:
+                return discount_percent, label
+        return 0, None
+
+async def _load_active_offers():
+    return await db.offers.find({"is_active": True}, {"_id": 0}).sort("min_usdt", 1).to_list(100)
+
+offers_cache = register_cache("offers", _load_active_offers)
+_discount_index: Optional[DiscountIndex] = None
+
+async def get_discount_index() -> DiscountIndex:
+    """Get the compiled discount index, rebuilding it when offers or the ICO start date change"""
+    global _discount_index
+    settings = await get_admin_settings()
+    offers = await offers_cache.get()
+    index = _discount_index
+    if index is None or index.offers is not offers or index.ico_start_date != settings["ico_start_date"]:
+        index = _discount_index = DiscountIndex(offers, settings["ico_start_date"])
+    return index
+
+async def refresh_discount_index():
+    await invalidate_cache(offers_cache)
+    await get_discount_index()
+
 async def get_applicable_discount(usdt_amount: float) -> tuple:
     """Get applicable discount based on amount and ICO validity"""
-    settings = await get_admin_settings()
-    ico_start = datetime.fromisoformat(settings["ico_start_date"].replace('Z', '+00:00'))
-    days_since_start = (datetime.now(timezone.utc) - ico_start).days
-    
-    # Find applicable offer
-    offers = await db.offers.find({"is_active": True}, {"_id": 0}).sort("min_usdt", -1).to_list(100)
-    
-    for offer in offers:
-        if offer["min_usdt"] <= usdt_amount <= offer["max_usdt"]:
-            if days_since_start <= offer["validity_days"]:
-                return offer["discount_percent"], f"${offer['min_usdt']}-${offer['max_usdt']} ({offer['discount_percent']}% bonus)"
-    
-    return 0, None
+    index = await get_discount_index()
+    return index.lookup(usdt_amount, datetime.now(timezone.utc))
+
+REFERRAL_RATES = [0.10, 0.05, 0.03]  # Level 1: 10%, Level 2: 5%, Level 3: 3%
+
+async def walk_ancestors(user: dict) -> list:
+    """Resolve a user's upline one referrer at a time (users created before ancestors were stored)"""
+    ancestors = []
+    referrer_id = user.get("referrer_id")
+    while referrer_id and len(ancestors) < len(REFERRAL_RATES):
+        ancestors.append(referrer_id)
+        referrer = await db.users.find_one({"id": referrer_id}, {"_id": 0, "referrer_id": 1})
+        referrer_id = referrer.get("referrer_id") if referrer else None
+    return ancestors
+
+async def get_ancestors(user: dict) -> list:
+    if "ancestors" in user:
+        return user["ancestors"]
+    return await walk_ancestors(user)
 
 async def calculate_referral_rewards(order_id: str, user_id: str, usdt_amount: float, gold_price: float):
     """Calculate 3-level referral rewards"""
-    referral_rates = [0.10, 0.05, 0.03]  # Level 1: 10%, Level 2: 5%, Level 3: 3%
+    user = await db.users.find_one({"id": user_id}, {"_id": 0, "referrer_id": 1, "ancestors": 1})
+    if not user:
+        return
     
-    current_user_id = user_id
-    for level in range(1, 4):
-        user = await db.users.find_one({"id": current_user_id}, {"_id": 0})
-        if not user or not user.get("referrer_id"):
-            break
-        
-        referrer_id = user["referrer_id"]
-        reward_usdt = usdt_amount * referral_rates[level - 1]
+    referrals = []
+    for level, referrer_id in enumerate(await get_ancestors(user), start=1):
+        reward_usdt = usdt_amount * REFERRAL_RATES[level - 1]
         reward_pio = reward_usdt / gold_price
         
-        referral = {
+        referrals.append({
             "id": str(uuid.uuid4()),
             "referrer_id": referrer_id,
             "referee_id": user_id,
@@ -329,89 +1133,1024 @@ async def calculate_referral_rewards(order_id: str, user_id: str, usdt_amount: f
             "reward_pio": reward_pio,
             "status": "pending",
             "created_at": datetime.now(timezone.utc).isoformat()
-        }
-        await db.referrals.insert_one(referral)
-        
-        current_user_id = referrer_id
+        })
+    
+    if referrals:
+        await db.referrals.insert_many(referrals)
+        await bump_stats(
+            pending_referrals=len(referrals),
+            pending_referral_pio=sum(r["reward_pio"] for r in referrals)
+        )
+
+def address_topic(address: str) -> str:
+    return "0x" + address.lower().removeprefix("0x").rjust(64, "0")
+
+def decode_usdt_transfer_log(log) -> Optional[dict]:
+    """Decode a USDT Transfer event log, or return None for any other log"""
+    if log["address"].lower() != USDT_CONTRACT.lower() or len(log["topics"]) != 3:
+        return None
+    topics = [AsyncWeb3.to_hex(topic).lower() for topic in log["topics"]]
+    if topics[0] != TRANSFER_EVENT_TOPIC:
+        return None
+    return {
+        "from": "0x" + topics[1][-40:],
+        "to": "0x" + topics[2][-40:],
+        "amount_wei": int.from_bytes(bytes(log["data"]), "big"),
+        "log_index": log["logIndex"]
+    }
+
+def decode_usdt_transfers(receipt, recipient: str) -> list:
+    """Decode the USDT Transfer events in a receipt that credit the recipient"""
+    transfers = []
+    for log in receipt["logs"]:
+        transfer = decode_usdt_transfer_log(log)
+        if transfer and transfer["to"] == recipient.lower():
+            transfers.append(transfer)
+    return transfers
+
+def check_usdt_transfers(transfers: list, expected_amount: float, expected_recipient: str, sender: str) -> dict:
+    """Check that decoded transfers add up to the expected USDT amount"""
+    if not transfers:
+        return {"valid": False, "error": f"No USDT transfer to {expected_recipient} in transaction"}
+    
+    amount_wei = sum(t["amount_wei"] for t in transfers)
+    expected_wei = int(Decimal(str(expected_amount)) * 10**USDT_DECIMALS)
+    amount = amount_wei / 10**USDT_DECIMALS
+    
+    logger.info(f"TX decoded: {len(transfers)} transfer(s) to {expected_recipient}, amount_wei={amount_wei}")
+    
+    if amount_wei * 100 < expected_wei * 99:  # Allow 1% tolerance
+        return {"valid": False, "error": f"Amount mismatch: expected {expected_amount}, got {amount}"}
+    
+    return {
+        "valid": True,
+        "amount": amount,
+        "amount_wei": amount_wei,
+        "from": sender,
+        "to": expected_recipient.lower(),
+        "transfers": len(transfers)
+    }
+
+def verify_usdt_receipt(receipt, expected_amount: float, expected_recipient: str) -> dict:
+    """Check that a mined receipt paid at least the expected USDT to the recipient"""
+    if receipt['status'] != 1:
+        return {"valid": False, "error": "Transaction failed"}
+    
+    transfers = decode_usdt_transfers(receipt, expected_recipient)
+    return check_usdt_transfers(transfers, expected_amount, expected_recipient, receipt['from'])
 
-async def verify_usdt_transaction(tx_hash: str, expected_amount: float, expected_recipient: str) -> dict:
-    """Verify USDT transaction on BSC"""
+# ==================== PAYOUT ENGINE ====================
+
+# Identifies this process when taking leases on shared background work
+WORKER_ID = str(uuid.uuid4())
+
+async def acquire_lease(name: str, seconds: float) -> bool:
+    """Take or renew a named lease so only one worker runs a singleton loop"""
+    now = datetime.now(timezone.utc)
     try:
-        tx = bsc_w3.eth.get_transaction(tx_hash)
-        receipt = bsc_w3.eth.get_transaction_receipt(tx_hash)
-        
-        if receipt['status'] != 1:
-            return {"valid": False, "error": "Transaction failed"}
-        
-        # Check if it's a USDT contract call
-        if tx['to'] and tx['to'].lower() != USDT_CONTRACT.lower():
-            return {"valid": False, "error": "Not a USDT transaction"}
+        await db.leases.find_one_and_update(
+            {"_id": name, "$or": [{"lease_until": {"$lt": now}}, {"owner": WORKER_ID}]},
+            {"$set": {"owner": WORKER_ID, "lease_until": now + timedelta(seconds=seconds)}},
+            upsert=True
+        )
+        return True
+    except DuplicateKeyError:
+        # Lease exists and another worker holds it
+        return False
+
+PIO_TRANSFER_GAS = 21000
+GAS_PRICE_TTL = float(os.environ.get('GAS_PRICE_TTL', '10'))
+PAYOUT_STUCK_AFTER = float(os.environ.get('PAYOUT_STUCK_AFTER', '120'))  # seconds unmined before a gas bump
+PAYOUT_GAS_BUMP = float(os.environ.get('PAYOUT_GAS_BUMP', '1.125'))  # nodes need >= 10% to replace a tx
+PAYOUT_MONITOR_INTERVAL = float(os.environ.get('PAYOUT_MONITOR_INTERVAL', '5'))
+
+SIGNING_WORKERS = int(os.environ.get('SIGNING_WORKERS', '2'))
+
+# secp256k1 key derivation and signing run here, off the event loop
+signing_executor = ThreadPoolExecutor(max_workers=SIGNING_WORKERS, thread_name_prefix="signer")
+
+class SignerCache:
+    """The ICO hot-wallet account, decrypted once per encrypted_private_key value"""
+
+    def __init__(self):
+        self.encrypted = None
+        self.account = None
+        self.builds = 0
+        self._lock = asyncio.Lock()
+
+    async def get(self, encrypted: str):
+        if encrypted == self.encrypted:
+            return self.account
+        async with self._lock:
+            # Concurrent first callers wait for one derivation instead of each running their own
+            if encrypted != self.encrypted:
+                private_key = decrypt_private_key(encrypted)
+                loop = asyncio.get_running_loop()
+                self.account = await loop.run_in_executor(signing_executor, Account.from_key, private_key)
+                self.encrypted = encrypted
+                self.builds += 1
+            return self.account
+
+    def clear(self):
+        self.encrypted = None
+        self.account = None
+
+ico_signer = SignerCache()
+
+async def get_ico_account():
+    settings = await get_admin_settings()
+    if not settings.get("encrypted_private_key"):
+        return None
+    return await ico_signer.get(settings["encrypted_private_key"])
+
+STALE_NONCE_ERRORS = ("nonce too low", "already known")
+
+def is_stale_nonce_error(error: Exception) -> bool:
+    message = str(error).lower()
+    return any(text in message for text in STALE_NONCE_ERRORS)
+
+class PayoutEngine:
+    """Submits native PIO transfers from the ICO account without waiting for them to be mined.
+
+    Nonces come from a counter in the nonce_state collection, so every
+    worker draws from the same sequence. The counter only moves forward:
+    a nonce whose transaction never reached the node goes onto a free list
+    and is handed out again, and the monitor fills any nonce left unused.
+    """
+
+    def __init__(self):
+        self.gas_price = None
+        self.gas_price_at = 0.0
+        self.submitted = 0
+        self.confirmed = 0
+        self.failed = 0
+        self.replaced = 0
+        self.gaps_filled = 0
+        self.suspected_gaps = set()
+
+    async def sync_nonce(self, address: str) -> int:
+        """Raise the counter to the chain's pending count and drop released nonces the chain has used.
+
+        Never lowers the counter under payouts in flight.
+        """
+        pending = await piogold_w3.eth.get_transaction_count(address, "pending")
+        doc = await db.nonce_state.find_one_and_update(
+            {"_id": address},
+            {"$max": {"next_nonce": pending}, "$pull": {"free": {"$lt": pending}},
+             "$set": {"synced_at": datetime.now(timezone.utc).isoformat()}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        return doc["next_nonce"]
+
+    async def allocate_nonce(self, address: str) -> int:
+        # Reuse the lowest released nonce first so no gap is left behind
+        doc = await db.nonce_state.find_one_and_update(
+            {"_id": address, "free.0": {"$exists": True}},
+            {"$pop": {"free": -1}}
+        )
+        if doc is not None:
+            return doc["free"][0]
+        doc = await db.nonce_state.find_one_and_update(
+            {"_id": address, "next_nonce": {"$exists": True}},
+            {"$inc": {"next_nonce": 1}}
+        )
+        if doc is None:
+            # First use: seed the counter only if nobody else has, so concurrent callers never reset it
+            pending = await piogold_w3.eth.get_transaction_count(address, "pending")
+            try:
+                await db.nonce_state.update_one(
+                    {"_id": address},
+                    {"$setOnInsert": {"next_nonce": pending, "synced_at": datetime.now(timezone.utc).isoformat()}},
+                    upsert=True
+                )
+            except DuplicateKeyError:
+                pass
+            return await self.allocate_nonce(address)
+        return doc["next_nonce"]
+
+    async def release_nonce(self, address: str, nonce: int):
+        """Hand back a nonce whose transaction never reached the node"""
+        await db.nonce_state.update_one(
+            {"_id": address},
+            {"$push": {"free": {"$each": [nonce], "$sort": 1}}}
+        )
+
+    async def current_gas_price(self) -> int:
+        loop_time = asyncio.get_running_loop().time()
+        if self.gas_price is None or loop_time - self.gas_price_at > GAS_PRICE_TTL:
+            self.gas_price = await piogold_w3.eth.gas_price
+            self.gas_price_at = loop_time
+        return self.gas_price
+
+    async def sign(self, account, nonce: int, recipient: str, amount_wei: int, gas_price: int):
+        tx = {
+            'nonce': nonce,
+            'to': AsyncWeb3.to_checksum_address(recipient),
+            'value': amount_wei,
+            'gas': PIO_TRANSFER_GAS,
+            'gasPrice': gas_price,
+            'chainId': PIOGOLD_CHAIN_ID
+        }
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(signing_executor, account.sign_transaction, tx)
+
+    async def broadcast(self, signed_tx) -> str:
+        tx_hash = AsyncWeb3.to_hex(signed_tx.hash)
+        try:
+            await piogold_w3.eth.send_raw_transaction(signed_tx.raw_transaction)
+        except Exception as e:
+            # A timeout can hide a broadcast that went through; only a node that has
+            # never seen the hash proves the transaction was not sent
+            try:
+                await piogold_w3.eth.get_transaction(tx_hash)
+            except TransactionNotFound:
+                raise e
+            except Exception:
+                logger.warning(f"Broadcast of {tx_hash} failed ({e}) and could not be checked; the monitor will re-send it")
+            else:
+                logger.warning(f"Broadcast of {tx_hash} reported {e} but the node has the transaction")
+        return tx_hash
+
+    async def send(self, account, nonce: int, recipient: str, amount_wei: int, gas_price: int) -> str:
+        return await self.broadcast(await self.sign(account, nonce, recipient, amount_wei, gas_price))
+
+    async def submit(self, account, recipient: str, amount_wei: int, kind: str, reference: Optional[str] = None) -> str:
+        """Sign and broadcast one transfer; returns its hash as soon as the node accepts it"""
+        nonce, gas_price = await asyncio.gather(
+            self.allocate_nonce(account.address),
+            self.current_gas_price()
+        )
+        return await self.submit_at(account, nonce, gas_price, recipient, amount_wei, kind, reference)
+
+    async def submit_at(self, account, nonce: int, gas_price: int, recipient: str, amount_wei: int,
+                        kind: str, reference: Optional[str] = None) -> str:
+        try:
+            signed_tx = await self.sign(account, nonce, recipient, amount_wei, gas_price)
+        except Exception:
+            await self.release_nonce(account.address, nonce)
+            raise
+        tx_hash = AsyncWeb3.to_hex(signed_tx.hash)
+        payout_id = str(uuid.uuid4())
+        # Recorded before broadcasting, so a crash after the node accepts it can't lose track of the payout.
+        # While active, the record also reserves (reference, kind): a second sender for the same
+        # reference gets the first one's hash instead of paying again.
+        try:
+            await db.payouts.insert_one({
+                "id": payout_id,
+                "kind": kind,
+                "reference": reference,
+                "from_address": account.address,
+                "to_address": recipient,
+                "amount_wei": str(amount_wei),
+                "nonce": nonce,
+                "gas_price": gas_price,
+                "tx_hash": tx_hash,
+                "tx_hashes": [tx_hash],
+                "status": "submitted",
+                "active": True,
+                "submitted_at": datetime.now(timezone.utc),
+                "created_at": datetime.now(timezone.utc).isoformat()
+            })
+        except DuplicateKeyError:
+            await self.release_nonce(account.address, nonce)
+            existing = await db.payouts.find_one(
+                {"reference": reference, "kind": kind, "active": True}, {"_id": 0, "tx_hash": 1}
+            )
+            if existing is None:
+                raise
+            return existing["tx_hash"]
+        except Exception:
+            await self.release_nonce(account.address, nonce)
+            raise
+        try:
+            await self.broadcast(signed_tx)
+        except Exception as e:
+            PAYOUTS.labels(kind, "error").inc()
+            await db.payouts.update_one({"id": payout_id}, {"$set": {"status": "unsent"}, "$unset": {"active": ""}})
+            if is_stale_nonce_error(e):
+                # The nonce is already used on chain; handing it out again would fail every later payout
+                await self.sync_nonce(account.address)
+            else:
+                await self.release_nonce(account.address, nonce)
+            raise
         
-        # Get input data as hex string
-        input_data = tx['input']
-        if isinstance(input_data, bytes):
-            input_data = '0x' + input_data.hex()
-        elif not input_data.startswith('0x'):
-            input_data = '0x' + input_data
+        self.submitted += 1
+        PAYOUTS.labels(kind, "submitted").inc()
+        return tx_hash
+
+    async def fill_nonce_gaps(self, account):
+        """Spend nonces no transaction holds, so payouts queued behind them can be mined"""
+        address = account.address
+        mined_nonce = await piogold_w3.eth.get_transaction_count(address, "latest")
+        # Released nonces the chain has moved past can never be used again
+        await db.nonce_state.update_one({"_id": address}, {"$pull": {"free": {"$lt": mined_nonce}}})
+        lowest = await db.payouts.find_one(
+            {"from_address": address, "status": "submitted", "nonce": {"$gte": mined_nonce}},
+            {"_id": 0, "nonce": 1, "submitted_at": 1},
+            sort=[("nonce", 1)]
+        )
+        if lowest is None or lowest["nonce"] == mined_nonce:
+            self.suspected_gaps.clear()
+            return
+        age = (datetime.now(timezone.utc) - lowest["submitted_at"].replace(tzinfo=timezone.utc)).total_seconds()
+        if age < PAYOUT_STUCK_AFTER:
+            return
+        gaps = set(range(mined_nonce, lowest["nonce"]))
+        suspected, self.suspected_gaps = self.suspected_gaps, set()
+        gas_price = await self.current_gas_price()
+        for nonce in sorted(gaps):
+            claimed = await db.nonce_state.update_one({"_id": address, "free": nonce}, {"$pull": {"free": nonce}})
+            if claimed.modified_count == 0 and nonce not in suspected:
+                # Possibly allocated a moment ago and about to be recorded; fill it if it is still missing next pass
+                self.suspected_gaps.add(nonce)
+                continue
+            tx_hash = await self.submit_at(account, nonce, gas_price, address, 0, "nonce_filler")
+            self.gaps_filled += 1
+            logger.warning(f"Filled unused nonce {nonce} with a zero-value transfer: {tx_hash}")
+
+    async def check_payout(self, payout: dict, account):
+        """Record a mined payout, or re-send a stuck one at the same nonce with a higher gas price"""
+        for tx_hash in reversed(payout["tx_hashes"]):
+            try:
+                receipt = await piogold_w3.eth.get_transaction_receipt(tx_hash)
+            except TransactionNotFound:
+                continue
+            status = "confirmed" if receipt["status"] == 1 else "failed"
+            update = {"$set": {"status": status, "tx_hash": tx_hash, "block_number": receipt["blockNumber"]}}
+            if status == "failed":
+                # Frees the reference for a retry
+                update["$unset"] = {"active": ""}
+            await db.payouts.update_one({"id": payout["id"]}, update)
+            await db.transactions.update_many(
+                {"tx_hash": {"$in": payout["tx_hashes"]}},
+                {"$set": {"tx_hash": tx_hash, "status": status}}
+            )
+            if tx_hash != payout["tx_hashes"][0]:
+                await db.orders.update_many(
+                    {"pio_tx_hash": {"$in": payout["tx_hashes"]}},
+                    {"$set": {"pio_tx_hash": tx_hash}}
+                )
+            if status == "confirmed":
+                self.confirmed += 1
+            else:
+                self.failed += 1
+            PAYOUTS.labels(payout["kind"], status).inc()
+            ORDER_STAGE_DURATION.labels("settlement").observe(
+                (datetime.now(timezone.utc) - parse_iso_datetime(payout["created_at"])).total_seconds()
+            )
+            await self.record_outcome(dict(payout, tx_hash=tx_hash), status)
+            return
         
-        # Decode transfer data
-        if len(input_data) >= 138:
-            method_id = input_data[:10].lower()
-            if method_id == '0xa9059cbb':  # transfer method
-                # Extract recipient (padded to 32 bytes, address is last 20 bytes)
-                recipient_hex = input_data[10:74]
-                recipient = '0x' + recipient_hex[-40:]  # Last 40 hex chars = 20 bytes
-                
-                # Extract amount
-                amount_hex = input_data[74:138]
-                amount = int(amount_hex, 16) / 10**18
-                
-                logger.info(f"TX decoded: recipient={recipient}, amount={amount}, expected_recipient={expected_recipient}")
-                
-                if recipient.lower() != expected_recipient.lower():
-                    return {"valid": False, "error": f"Wrong recipient: expected {expected_recipient}, got {recipient}"}
-                
-                if amount < expected_amount * 0.99:  # Allow 1% tolerance
-                    return {"valid": False, "error": f"Amount mismatch: expected {expected_amount}, got {amount}"}
-                
-                return {"valid": True, "amount": amount, "from": tx['from'], "to": recipient}
+        age = (datetime.now(timezone.utc) - payout["submitted_at"].replace(tzinfo=timezone.utc)).total_seconds()
+        if age < PAYOUT_STUCK_AFTER or account is None or account.address != payout["from_address"]:
+            return
+        mined_nonce = await piogold_w3.eth.get_transaction_count(payout["from_address"], "latest")
+        if mined_nonce > payout["nonce"]:
+            # The nonce was consumed by a transaction we have no hash for
+            await db.payouts.update_one({"id": payout["id"]}, {"$set": {"status": "dropped"}, "$unset": {"active": ""}})
+            self.failed += 1
+            PAYOUTS.labels(payout["kind"], "dropped").inc()
+            logger.error(f"Payout {payout['id']} nonce {payout['nonce']} was used by another transaction")
+            await self.record_outcome(payout, "dropped")
+            return
+        if mined_nonce < payout["nonce"]:
+            # Waiting behind an earlier nonce; only the lowest stuck payout gets bumped
+            return
         
-        return {"valid": False, "error": f"Could not decode transaction, input length: {len(input_data)}"}
-    except Exception as e:
-        logger.error(f"TX verification error: {e}")
-        return {"valid": False, "error": str(e)}
+        gas_price = max(int(payout["gas_price"] * PAYOUT_GAS_BUMP) + 1, await self.current_gas_price())
+        tx_hash = await self.send(account, payout["nonce"], payout["to_address"], int(payout["amount_wei"]), gas_price)
+        await db.payouts.update_one(
+            {"id": payout["id"]},
+            {"$set": {"gas_price": gas_price, "tx_hash": tx_hash, "submitted_at": datetime.now(timezone.utc)},
+             "$push": {"tx_hashes": tx_hash}}
+        )
+        self.replaced += 1
+        PAYOUTS.labels(payout["kind"], "replaced").inc()
+        logger.info(f"Payout {payout['id']} re-sent at nonce {payout['nonce']} with gas price {gas_price}: {tx_hash}")
+
+    async def record_outcome(self, payout: dict, status: str):
+        """Let whatever the payout paid for react to it being confirmed, failing or being dropped"""
+        handler = PAYOUT_OUTCOME_HANDLERS.get(payout["kind"])
+        if handler and payout.get("reference"):
+            await handler(payout, status)
+
+    async def run_monitor(self):
+        """Track submitted payouts until they are mined"""
+        while True:
+            try:
+                if await acquire_lease("payout_monitor", PAYOUT_MONITOR_INTERVAL * 6):
+                    payouts = await db.payouts.find({"status": "submitted"}, {"_id": 0}).sort("nonce", 1).to_list(500)
+                    if payouts:
+                        account = await get_ico_account()
+                        for payout in payouts:
+                            await self.check_payout(payout, account)
+                        if account is not None:
+                            await self.fill_nonce_gaps(account)
+                    await release_stale_referral_claims()
+            except Exception as e:
+                logger.error(f"Payout monitor error: {e}")
+            await asyncio.sleep(PAYOUT_MONITOR_INTERVAL)
+
+    def stats(self) -> dict:
+        return {
+            "submitted": self.submitted,
+            "confirmed": self.confirmed,
+            "failed": self.failed,
+            "replaced": self.replaced,
+            "gaps_filled": self.gaps_filled
+        }
 
-async def send_pio_native(recipient: str, amount: float) -> dict:
+payout_engine = PayoutEngine()
+
+@timed("send_pio_native")
+async def send_pio_native(recipient: str, amount: float, reference: Optional[str] = None, kind: str = "pio_transfer") -> dict:
     """Send PIO native coin to user"""
     try:
-        settings = await get_admin_settings()
-        if not settings.get("encrypted_private_key"):
+        account = await get_ico_account()
+        if account is None:
             return {"success": False, "error": "Admin private key not configured"}
         
-        private_key = decrypt_private_key(settings["encrypted_private_key"])
-        account = piogold_w3.eth.account.from_key(private_key)
-        
-        nonce = piogold_w3.eth.get_transaction_count(account.address)
-        gas_price = piogold_w3.eth.gas_price
-        
-        amount_wei = int(amount * 10**18)
+        amount_wei = int(Decimal(str(amount)) * 10**18)
+        tx_hash = await payout_engine.submit(account, recipient, amount_wei, kind, reference)
+        return {"success": True, "tx_hash": tx_hash}
+    except Exception as e:
+        logger.error(f"PIO transfer error: {e}")
+        return {"success": False, "error": str(e)}
+
+# ==================== PAYMENT SCANNER ====================
+
+PAYMENT_SCANNER_ENABLED = os.environ.get('PAYMENT_SCANNER_ENABLED', 'true').lower() == 'true'
+SCANNER_BATCH_BLOCKS = int(os.environ.get('SCANNER_BATCH_BLOCKS', '1000'))  # blocks per eth_getLogs call
+SCANNER_CONFIRMATIONS = int(os.environ.get('SCANNER_CONFIRMATIONS', '3'))  # stay this far behind the head
+SCANNER_START_LOOKBACK = int(os.environ.get('SCANNER_START_LOOKBACK', '1200'))  # ~1 hour of BSC blocks
+SCANNER_INTERVAL = float(os.environ.get('SCANNER_INTERVAL', '3'))
+SCANNER_LEASE_SECONDS = 30
+SCANNER_CURSOR_ID = "bsc_usdt"
+
+scanner_status = {"running": False, "last_block": None, "head": None, "payments_ingested": 0, "last_error": None}
+
+async def ingest_usdt_logs(logs: list) -> int:
+    payments = []
+    for log in logs:
+        transfer = decode_usdt_transfer_log(log)
+        if not transfer:
+            continue
+        tx_hash = AsyncWeb3.to_hex(log["transactionHash"]).lower()
+        payments.append(UpdateOne(
+            {"tx_hash": tx_hash, "log_index": transfer["log_index"]},
+            {"$setOnInsert": {
+                "id": str(uuid.uuid4()),
+                "tx_hash": tx_hash,
+                "log_index": transfer["log_index"],
+                "block_number": log["blockNumber"],
+                "from_address": transfer["from"],
+                "to_address": transfer["to"],
+                # Stored as a string: 18-decimal amounts overflow MongoDB's int64
+                "amount_wei": str(transfer["amount_wei"]),
+                "amount": transfer["amount_wei"] / 10**USDT_DECIMALS,
+                "order_id": None,
+                "created_at": datetime.now(timezone.utc).isoformat()
+            }},
+            upsert=True
+        ))
+    if not payments:
+        return 0
+    result = await db.usdt_payments.bulk_write(payments, ordered=False)
+    return result.upserted_count
+
+async def scan_usdt_payments_once() -> int:
+    """Ingest confirmed USDT transfers to the ICO wallet since the stored cursor"""
+    settings = await get_admin_settings()
+    wallet = settings["ico_wallet_address"].lower()
+    if not wallet:
+        return 0
+    
+    head = await bsc_w3.eth.block_number
+    safe_head = head - SCANNER_CONFIRMATIONS
+    scanner_status["head"] = head
+    
+    cursor = await db.scanner_state.find_one({"_id": SCANNER_CURSOR_ID})
+    if cursor and cursor.get("wallet") == wallet and cursor.get("last_block") is not None:
+        last_block = cursor["last_block"]
+    else:
+        # First run or the ICO wallet changed: start a little behind the head
+        last_block = safe_head - SCANNER_START_LOOKBACK
+    
+    ingested = 0
+    while last_block < safe_head:
+        to_block = min(last_block + SCANNER_BATCH_BLOCKS, safe_head)
+        logs = await bsc_w3.eth.get_logs({
+            "fromBlock": last_block + 1,
+            "toBlock": to_block,
+            "address": AsyncWeb3.to_checksum_address(USDT_CONTRACT),
+            "topics": [TRANSFER_EVENT_TOPIC, None, address_topic(wallet)]
+        })
+        ingested += await ingest_usdt_logs(logs)
+        last_block = to_block
+        await db.scanner_state.update_one(
+            {"_id": SCANNER_CURSOR_ID},
+            {"$set": {"wallet": wallet, "last_block": last_block, "updated_at": datetime.now(timezone.utc).isoformat()}}
+        )
+        scanner_status["last_block"] = last_block
+    
+    scanner_status["payments_ingested"] += ingested
+    return ingested
+
+async def run_payment_scanner():
+    """Follow BSC with eth_getLogs and record incoming USDT payments"""
+    scanner_status["running"] = True
+    while True:
+        try:
+            if await acquire_lease("payment_scanner", SCANNER_LEASE_SECONDS):
+                await scan_usdt_payments_once()
+                scanner_status["last_error"] = None
+        except Exception as e:
+            scanner_status["last_error"] = str(e)
+            logger.error(f"Payment scanner error: {e}")
+        await asyncio.sleep(SCANNER_INTERVAL)
+
+async def get_ingested_payments(tx_hash: str, recipient: str) -> list:
+    """Get transfers to the recipient that the scanner has already ingested for a tx hash"""
+    payments = await db.usdt_payments.find(
+        {"tx_hash": tx_hash.lower(), "to_address": recipient.lower()}, {"_id": 0}
+    ).to_list(100)
+    return [{**p, "amount_wei": int(p["amount_wei"])} for p in payments]
+
+# ==================== ORDER PROCESSING ====================
+
+CONFIRMATION_DEPTH = int(os.environ.get('CONFIRMATION_DEPTH', '3'))  # blocks including the one holding the tx
+CONFIRMATION_POLL_MIN = float(os.environ.get('CONFIRMATION_POLL_MIN', '1'))
+CONFIRMATION_POLL_MAX = float(os.environ.get('CONFIRMATION_POLL_MAX', '30'))
+CONFIRMATION_TIMEOUT = float(os.environ.get('CONFIRMATION_TIMEOUT', '1800'))  # give up on a tx never mined
+BSC_BLOCK_TIME = float(os.environ.get('BSC_BLOCK_TIME', '3'))
+
+def confirmation_backoff(polls: int) -> float:
+    return min(CONFIRMATION_POLL_MIN * 2 ** polls, CONFIRMATION_POLL_MAX)
+
+async def fail_verification(order_id: str, error: str):
+    await db.orders.update_one(
+        {"id": order_id},
+        {"$set": {"status": "verification_failed", "error": error}}
+    )
+    await db.transactions.update_one(
+        {"order_id": order_id, "type": "usdt_payment"},
+        {"$set": {"status": "failed"}}
+    )
+
+@timed("verify_usdt_payment")
+async def verify_order_payment(order: dict, recipient: str) -> Optional[dict]:
+    """Check an order's USDT transfer, preferring transfers the scanner has already ingested.
+
+    Returns None while the transaction is not on chain yet.
+    """
+    payments = await get_ingested_payments(order["usdt_tx_hash"], recipient)
+    if payments:
+        verification = check_usdt_transfers(payments, order["usdt_amount"], recipient, payments[0]["from_address"])
+        return {**verification, "block_number": max(p["block_number"] for p in payments), "payments": payments}
+    try:
+        receipt = await bsc_w3.eth.get_transaction_receipt(order["usdt_tx_hash"])
+    except TransactionNotFound:
+        return None
+    verification = verify_usdt_receipt(receipt, order["usdt_amount"], recipient)
+    return {**verification, "block_number": receipt["blockNumber"], "payments": []}
+
+@timed("process_order")
+async def process_order(order_id: str, head: int, polls: int = 0) -> Optional[float]:
+    """Run one confirmation check for an order.
+
+    Returns the delay until the next check, or None once the order has left
+    the verification stages.
+    """
+    order = await db.orders.find_one({"id": order_id}, {"_id": 0})
+    if not order or order["status"] not in ("pending_verification", "confirming", "verified"):
+        return None
+    
+    settings = await get_admin_settings()
+    if order["status"] == "verified":
+        # A previous attempt stopped between verification and payout
+        await fulfil_order(order, settings)
+        return None
+    recipient = settings["ico_wallet_address"]
+    
+    verification = await verify_order_payment(order, recipient)
+    if verification is None:
+        age = (datetime.now(timezone.utc) - parse_iso_datetime(order["created_at"])).total_seconds()
+        if age > CONFIRMATION_TIMEOUT:
+            await fail_verification(order_id, "Transaction not found on chain")
+            return None
+        return confirmation_backoff(polls)
+    payments, block_number = verification["payments"], verification["block_number"]
+    
+    if not verification["valid"]:
+        await fail_verification(order_id, verification.get("error"))
+        return None
+    
+    confirmations = head - block_number + 1
+    if confirmations < CONFIRMATION_DEPTH:
+        await db.orders.update_one(
+            {"id": order_id},
+            {"$set": {"status": "confirming", "confirmations": max(confirmations, 0)}}
+        )
+        # Check back when the remaining blocks should have been produced
+        return max((CONFIRMATION_DEPTH - confirmations) * BSC_BLOCK_TIME, CONFIRMATION_POLL_MIN)
+    
+    if payments:
+        # One ingested transfer pays one order: claim it through its first log before fulfilling
+        first = min(payments, key=lambda p: p["log_index"])
+        claimed = await db.usdt_payments.find_one_and_update(
+            {"tx_hash": first["tx_hash"], "log_index": first["log_index"], "order_id": {"$in": [None, order_id]}},
+            {"$set": {"order_id": order_id}}
+        )
+        if claimed is None:
+            await fail_verification(order_id, "Payment already used by another order")
+            return None
+    
+    verified_at = datetime.now(timezone.utc)
+    result = await db.orders.update_one(
+        {"id": order_id, "status": {"$in": ["pending_verification", "confirming"]}},
+        {"$set": {"status": "verified", "confirmations": confirmations, "verified_at": verified_at.isoformat()}}
+    )
+    if result.modified_count == 0:
+        return None
+    ORDER_STAGE_DURATION.labels("verification").observe(
+        (verified_at - parse_iso_datetime(order["created_at"])).total_seconds()
+    )
+    order["verified_at"] = verified_at.isoformat()
+    if payments:
+        await db.usdt_payments.update_many(
+            {"tx_hash": order["usdt_tx_hash"].lower(), "order_id": None}, {"$set": {"order_id": order_id}}
+        )
+    
+    await fulfil_order(order, settings)
+    return None
+
+async def fulfil_order(order: dict, settings: dict):
+    """Send PIO for a verified order and record the rewards; safe to run again for the same order"""
+    order_id = order["id"]
+    
+    # Update USDT transaction status
+    await db.transactions.update_one(
+        {"order_id": order_id, "type": "usdt_payment"},
+        {"$set": {"status": "confirmed"}}
+    )
+    
+    # Send PIO, unless an earlier attempt already did before it was interrupted
+    payout = await db.payouts.find_one(
+        {"reference": order_id, "kind": "pio_transfer", "status": {"$in": ["submitted", "confirmed"]}},
+        {"_id": 0, "tx_hash": 1}
+    )
+    if payout:
+        pio_result = {"success": True, "tx_hash": payout["tx_hash"]}
+    else:
+        pio_result = await send_pio_native(order["wallet_address"], order["total_pio"], reference=order_id)
+    
+    if pio_result["success"]:
+        result = await db.orders.update_one(
+            {"id": order_id, "status": "verified"},
+            {"$set": {
+                "status": "completed",
+                "pio_tx_hash": pio_result["tx_hash"]
+            }}
+        )
+        if result.modified_count == 0:
+            return
+        if order.get("verified_at"):
+            ORDER_STAGE_DURATION.labels("payout").observe(
+                (datetime.now(timezone.utc) - parse_iso_datetime(order["verified_at"])).total_seconds()
+            )
         
-        tx = {
-            'nonce': nonce,
-            'to': Web3.to_checksum_address(recipient),
-            'value': amount_wei,
-            'gas': 21000,
-            'gasPrice': gas_price,
-            'chainId': PIOGOLD_CHAIN_ID
+        # Create PIO transaction record
+        pio_tx = {
+            "id": str(uuid.uuid4()),
+            "order_id": order_id,
+            "type": "pio_transfer",
+            "from_address": settings["ico_wallet_address"],
+            "to_address": order["wallet_address"],
+            "amount": order["total_pio"],
+            "tx_hash": pio_result["tx_hash"],
+            "chain": "piogold",
+            "status": "pending",  # confirmed by the payout monitor once mined
+            "created_at": datetime.now(timezone.utc).isoformat()
         }
+        await db.transactions.insert_one(pio_tx)
         
-        signed_tx = piogold_w3.eth.account.sign_transaction(tx, private_key)
-        tx_hash = piogold_w3.eth.send_raw_transaction(signed_tx.raw_transaction)
+        await bump_stats(completed_orders=1, total_usdt_raised=order["usdt_amount"], total_pio_sold=order["total_pio"])
+        
+        # Update user totals
+        await db.users.update_one(
+            {"id": order["user_id"]},
+            {"$inc": {
+                "total_purchased_usdt": order["usdt_amount"],
+                "total_pio_received": order["total_pio"]
+            }}
+        )
         
-        return {"success": True, "tx_hash": tx_hash.hex()}
+        # Calculate referral rewards
+        await calculate_referral_rewards(
+            order_id, order["user_id"], order["usdt_amount"], order["gold_price"]
+        )
+    else:
+        await db.orders.update_one(
+            {"id": order_id, "status": "verified"},
+            {"$set": {"status": "pio_transfer_failed", "error": pio_result.get("error")}}
+        )
+
+async def handle_order_payout_outcome(payout: dict, status: str):
+    """Flag an order whose PIO transfer failed or was dropped after it was marked completed"""
+    if status == "confirmed":
+        return
+    order = await db.orders.find_one_and_update(
+        {"id": payout["reference"], "status": "completed", "pio_tx_hash": {"$in": payout["tx_hashes"]}},
+        {"$set": {"status": "pio_transfer_failed", "error": f"PIO transfer {status} on chain"}}
+    )
+    if order is None:
+        return
+    await bump_stats(completed_orders=-1, total_usdt_raised=-order["usdt_amount"], total_pio_sold=-order["total_pio"])
+    await db.users.update_one(
+        {"id": order["user_id"]},
+        {"$inc": {"total_purchased_usdt": -order["usdt_amount"], "total_pio_received": -order["total_pio"]}}
+    )
+    # Rewards for a purchase that was never delivered must not be paid; a retry creates them again
+    pending = await db.referrals.find(
+        {"order_id": order["id"], "status": "pending"}, {"_id": 0, "reward_pio": 1}
+    ).to_list(None)
+    await db.referrals.update_many(
+        {"order_id": order["id"], "status": {"$in": ["pending", "approved"]}},
+        {"$set": {"status": "rejected", "updated_at": datetime.now(timezone.utc).isoformat()}}
+    )
+    if pending:
+        await bump_stats(pending_referrals=-len(pending), pending_referral_pio=-sum(r["reward_pio"] for r in pending))
+    logger.error(f"Order {order['id']} PIO transfer {status}; order flagged pio_transfer_failed")
+
+PAYOUT_OUTCOME_HANDLERS = {
+    "pio_transfer": handle_order_payout_outcome,
+}
+
+async def get_bsc_head() -> int:
+    """Latest BSC block number, shared by concurrent confirmation checks for a fraction of a block"""
+    loop_time = asyncio.get_running_loop().time()
+    if _bsc_head["value"] is None or loop_time - _bsc_head["at"] > BSC_BLOCK_TIME / 3:
+        _bsc_head["value"] = await bsc_w3.eth.block_number
+        _bsc_head["at"] = loop_time
+    return _bsc_head["value"]
+
+_bsc_head = {"value": None, "at": 0.0}
+
+async def run_process_order_job(job: dict) -> Optional[float]:
+    head = await get_bsc_head()
+    return await process_order(job["payload"]["order_id"], head, job.get("polls", 0))
+
+# ==================== JOB QUEUE ====================
+
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', '4'))
+JOB_VISIBILITY_TIMEOUT = float(os.environ.get('JOB_VISIBILITY_TIMEOUT', '120'))  # lease before a job is redelivered
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', '8'))
+JOB_RETRY_BASE = float(os.environ.get('JOB_RETRY_BASE', '2'))
+JOB_RETRY_MAX = float(os.environ.get('JOB_RETRY_MAX', '300'))
+JOB_IDLE_POLL = float(os.environ.get('JOB_IDLE_POLL', '1'))
+
+JOB_HANDLERS = {
+    "process_order": run_process_order_job,
+}
+
+job_wakeup = asyncio.Event()
+
+async def enqueue_job(job_type: str, key: str, payload: dict, delay: float = 0):
+    """Queue a job once per (type, key); enqueueing an existing job is a no-op"""
+    now = datetime.now(timezone.utc)
+    await db.jobs.update_one(
+        {"id": f"{job_type}:{key}"},
+        {"$setOnInsert": {
+            "id": f"{job_type}:{key}",
+            "type": job_type,
+            "payload": payload,
+            "status": "queued",
+            "attempts": 0,
+            "polls": 0,
+            "run_at": now + timedelta(seconds=delay),
+            "lease_until": None,
+            "owner": None,
+            "last_error": None,
+            "created_at": now.isoformat()
+        }},
+        upsert=True
+    )
+    job_wakeup.set()
+
+async def requeue_job(job_type: str, key: str, payload: dict):
+    """Queue a job, running it again if an earlier run already finished"""
+    await enqueue_job(job_type, key, payload)
+    await db.jobs.update_one(
+        {"id": f"{job_type}:{key}", "status": {"$in": ["done", "dead"]}},
+        {"$set": {"status": "queued", "attempts": 0, "polls": 0, "run_at": datetime.now(timezone.utc), "last_error": None}}
+    )
+    job_wakeup.set()
+
+async def claim_job() -> Optional[dict]:
+    """Lease the next due job, including ones whose previous lease expired"""
+    now = datetime.now(timezone.utc)
+    return await db.jobs.find_one_and_update(
+        {"$or": [
+            {"status": "queued", "run_at": {"$lte": now}},
+            {"status": "running", "lease_until": {"$lt": now}}
+        ]},
+        {
+            "$set": {"status": "running", "owner": WORKER_ID, "lease_until": now + timedelta(seconds=JOB_VISIBILITY_TIMEOUT)},
+            "$inc": {"attempts": 1}
+        },
+        sort=[("run_at", 1)],
+        return_document=ReturnDocument.AFTER
+    )
+
+async def renew_job_lease(owned: dict):
+    """Extend a running job's lease so it is not redelivered while its handler is still working"""
+    while True:
+        await asyncio.sleep(JOB_VISIBILITY_TIMEOUT / 3)
+        try:
+            result = await db.jobs.update_one(owned, {"$set": {
+                "lease_until": datetime.now(timezone.utc) + timedelta(seconds=JOB_VISIBILITY_TIMEOUT)
+            }})
+        except Exception as e:
+            logger.warning(f"Job {owned['id']} lease renewal failed: {e}")
+            continue
+        if result.matched_count == 0:
+            logger.warning(f"Job {owned['id']} lease lost while running")
+            return
+
+async def run_job(job: dict):
+    current_route.set(f"job:{job['type']}")
+    owned = {"id": job["id"], "owner": WORKER_ID, "status": "running"}
+    heartbeat = asyncio.create_task(renew_job_lease(owned))
+    try:
+        delay = await JOB_HANDLERS[job["type"]](job)
     except Exception as e:
-        logger.error(f"PIO transfer error: {e}")
-        return {"success": False, "error": str(e)}
+        heartbeat.cancel()
+        logger.error(f"Job {job['id']} failed (attempt {job['attempts']}): {e}")
+        if job["attempts"] >= JOB_MAX_ATTEMPTS:
+            await db.jobs.update_one(owned, {"$set": {"status": "dead", "last_error": str(e), "lease_until": None}})
+            logger.error(f"Job {job['id']} moved to dead-letter after {job['attempts']} attempts")
+        else:
+            retry_in = min(JOB_RETRY_BASE * 2 ** (job["attempts"] - 1), JOB_RETRY_MAX)
+            await db.jobs.update_one(owned, {"$set": {
+                "status": "queued", "last_error": str(e), "lease_until": None,
+                "run_at": datetime.now(timezone.utc) + timedelta(seconds=retry_in)
+            }})
+        return
+    heartbeat.cancel()
+    
+    now = datetime.now(timezone.utc)
+    if delay is None:
+        await db.jobs.update_one(owned, {"$set": {"status": "done", "lease_until": None, "finished_at": now.isoformat()}})
+    else:
+        # Not a failure: the job asked to run again later (e.g. waiting for confirmations)
+        await db.jobs.update_one(owned, {
+            "$set": {"status": "queued", "attempts": 0, "lease_until": None, "run_at": now + timedelta(seconds=delay)},
+            "$inc": {"polls": 1}
+        })
+
+async def job_worker():
+    """Drain the job queue; JOB_WORKERS of these run per process"""
+    while True:
+        try:
+            job = await claim_job()
+        except Exception as e:
+            logger.error(f"Job claim error: {e}")
+            job = None
+        if job:
+            try:
+                await run_job(job)
+            except Exception as e:
+                # Leave the job leased; it is redelivered once the visibility timeout passes
+                logger.error(f"Job {job['id']} bookkeeping error: {e}")
+            continue
+        job_wakeup.clear()
+        try:
+            await asyncio.wait_for(job_wakeup.wait(), JOB_IDLE_POLL)
+        except asyncio.TimeoutError:
+            pass
+
+async def recover_pending_orders():
+    """Re-queue orders left mid-verification or verified but never paid by a previous process"""
+    recovered = 0
+    async for order in db.orders.find(
+        {"status": {"$in": ["pending_verification", "confirming", "verified"]}}, {"_id": 0, "id": 1, "status": 1}
+    ):
+        if order["status"] == "verified":
+            # Its job may already be marked done by a run that died before paying out
+            await requeue_job("process_order", order["id"], {"order_id": order["id"]})
+        else:
+            await enqueue_job("process_order", order["id"], {"order_id": order["id"]})
+        recovered += 1
+    if recovered:
+        logger.info(f"Recovered {recovered} order(s) awaiting verification")
+
+async def get_job_queue_stats() -> dict:
+    counts = await db.jobs.aggregate([{"$group": {"_id": "$status", "count": {"$sum": 1}}}]).to_list(10)
+    return {doc["_id"]: doc["count"] for doc in counts}
+
+# ==================== DASHBOARD STATS ====================
+
+STATS_ID = "global"
+STATS_RECONCILE_INTERVAL = float(os.environ.get('STATS_RECONCILE_INTERVAL', '600'))
+
+async def bump_stats(**deltas):
+    """Apply counter deltas to the dashboard stats document"""
+    await db.stats.update_one({"_id": STATS_ID}, {"$inc": deltas}, upsert=True)
+
+async def reconcile_stats() -> dict:
+    """Recompute the dashboard counters from the source collections and overwrite any drift"""
+    order_totals, pending_totals = await asyncio.gather(
+        db.orders.aggregate([
+            {"$match": {"status": "completed"}},
+            {"$group": {"_id": None, "count": {"$sum": 1}, "total_usdt": {"$sum": "$usdt_amount"}, "total_pio": {"$sum": "$total_pio"}}}
+        ]).to_list(1),
+        db.referrals.aggregate([
+            {"$match": {"status": "pending"}},
+            {"$group": {"_id": None, "count": {"$sum": 1}, "reward_pio": {"$sum": "$reward_pio"}}}
+        ]).to_list(1)
+    )
+    completed = order_totals[0] if order_totals else {}
+    pending = pending_totals[0] if pending_totals else {}
+    
+    stats = {
+        "total_users": await db.users.count_documents({}),
+        "total_orders": await db.orders.count_documents({}),
+        "completed_orders": completed.get("count", 0),
+        "total_usdt_raised": completed.get("total_usdt", 0),
+        "total_pio_sold": completed.get("total_pio", 0),
+        "pending_referrals": pending.get("count", 0),
+        "pending_referral_pio": pending.get("reward_pio", 0),
+        "reconciled_at": datetime.now(timezone.utc).isoformat()
+    }
+    await db.stats.update_one({"_id": STATS_ID}, {"$set": stats}, upsert=True)
+    return stats
+
+async def run_stats_reconciler():
+    while True:
+        await asyncio.sleep(STATS_RECONCILE_INTERVAL)
+        try:
+            if await acquire_lease("stats_reconciler", STATS_RECONCILE_INTERVAL / 2):
+                await reconcile_stats()
+        except Exception as e:
+            logger.error(f"Stats reconciliation error: {e}")
+
+# ==================== HEALTH ====================
+
+HEALTH_INTERVAL = float(os.environ.get('HEALTH_INTERVAL', '10'))
+HEALTH_SAMPLE_TIMEOUT = float(os.environ.get('HEALTH_SAMPLE_TIMEOUT', '5'))
+HEALTH_MAX_HEAD_LAG = float(os.environ.get('HEALTH_MAX_HEAD_LAG', '120'))  # seconds behind wall clock
+HEALTH_STALE_AFTER = HEALTH_INTERVAL * 3 + HEALTH_SAMPLE_TIMEOUT
+
+health_snapshot = {"chains": {}, "database": None, "sampled_at": None}
+
+async def sample_chain(w3) -> dict:
+    """Latest block, how far it trails the wall clock, and how long the RPC took to answer"""
+    started = asyncio.get_running_loop().time()
+    try:
+        block = await asyncio.wait_for(w3.eth.get_block("latest"), HEALTH_SAMPLE_TIMEOUT)
+    except Exception as e:
+        return {"connected": False, "block": None, "head_lag": None, "latency_ms": None, "error": str(e) or type(e).__name__}
+    latency_ms = (asyncio.get_running_loop().time() - started) * 1000
+    head_lag = datetime.now(timezone.utc).timestamp() - block["timestamp"]
+    return {
+        "connected": True,
+        "block": block["number"],
+        "head_lag": round(head_lag, 1),
+        "latency_ms": round(latency_ms, 1),
+        "error": None
+    }
+
+async def sample_database() -> dict:
+    started = asyncio.get_running_loop().time()
+    try:
+        await asyncio.wait_for(db.command("ping"), HEALTH_SAMPLE_TIMEOUT)
+    except Exception as e:
+        return {"connected": False, "latency_ms": None, "error": str(e) or type(e).__name__}
+    return {"connected": True, "latency_ms": round((asyncio.get_running_loop().time() - started) * 1000, 1), "error": None}
+
+async def refresh_health():
+    bsc, piogold, database = await asyncio.gather(sample_chain(bsc_w3), sample_chain(piogold_w3), sample_database())
+    health_snapshot["chains"] = {"bsc": bsc, "piogold": piogold}
+    health_snapshot["database"] = database
+    health_snapshot["sampled_at"] = datetime.now(timezone.utc)
+
+async def run_health_monitor():
+    """Sample dependencies in the background so health probes never wait on an RPC"""
+    while True:
+        try:
+            await refresh_health()
+        except Exception as e:
+            logger.error(f"Health monitor error: {e}")
+        await asyncio.sleep(HEALTH_INTERVAL)
+
+def chain_healthy(chain: dict) -> bool:
+    return chain["connected"] and chain["head_lag"] <= HEALTH_MAX_HEAD_LAG
+
+def health_age() -> Optional[float]:
+    if health_snapshot["sampled_at"] is None:
+        return None
+    return (datetime.now(timezone.utc) - health_snapshot["sampled_at"]).total_seconds()
 
 # ==================== PUBLIC ENDPOINTS ====================
 
@@ -421,28 +2160,66 @@ async def root():
 
 @api_router.get("/health")
 async def health():
+    """Last background health sample; never touches the chains itself"""
+    chains = health_snapshot["chains"]
+    age = health_age()
+    healthy = (
+        age is not None and age <= HEALTH_STALE_AFTER
+        and health_snapshot["database"]["connected"]
+        and all(chain_healthy(chain) for chain in chains.values())
+    )
     return {
-        "status": "healthy",
-        "bsc_connected": bsc_w3.is_connected(),
-        "piogold_connected": piogold_w3.is_connected()
+        "status": "healthy" if healthy else "degraded",
+        "bsc_connected": chains.get("bsc", {}).get("connected", False),
+        "piogold_connected": chains.get("piogold", {}).get("connected", False),
+        "chains": chains,
+        "database": health_snapshot["database"],
+        "sample_age": round(age, 1) if age is not None else None
     }
 
-@api_router.get("/settings/public")
-async def get_public_settings():
-    """Get public ICO settings"""
+@api_router.get("/health/live")
+async def health_live():
+    """Liveness: the event loop is serving requests"""
+    return {"status": "alive"}
+
+@api_router.get("/health/ready")
+async def health_ready(response: Response):
+    """Readiness: a recent sample shows the database reachable"""
+    age = health_age()
+    ready = age is not None and age <= HEALTH_STALE_AFTER and health_snapshot["database"]["connected"]
+    # Chain RPC trouble is reported but does not pull the pod out of rotation; every pod shares the same RPCs
+    if not ready:
+        response.status_code = 503
+    return {
+        "status": "ready" if ready else "not_ready",
+        "database": health_snapshot["database"],
+        "chains_healthy": {name: chain_healthy(chain) for name, chain in health_snapshot["chains"].items()},
+        "sample_age": round(age, 1) if age is not None else None
+    }
+
+async def _load_team():
+    return await db.team_members.find({}, {"_id": 0}).to_list(10)
+
+async def _load_legal_documents():
+    return {doc["slug"]: doc async for doc in db.legal_documents.find({"is_active": True}, {"_id": 0})}
+
+team_cache = register_cache("team", _load_team)
+legal_cache = register_cache("legal", _load_legal_documents)
+public_settings_responses = ResponseCache(settings_cache, offers_cache, team_cache, legal_cache)
+team_responses = ResponseCache(team_cache)
+legal_responses = ResponseCache(legal_cache)
+
+async def build_public_settings(days_since_start: int) -> dict:
     settings = await get_admin_settings()
     
     # Get active offers
-    offers = await db.offers.find({"is_active": True}, {"_id": 0}).sort("min_usdt", 1).to_list(100)
+    offers = await offers_cache.get()
     
-    ico_start = datetime.fromisoformat(settings["ico_start_date"].replace('Z', '+00:00'))
-    days_since_start = (datetime.now(timezone.utc) - ico_start).days
-    
-    # Get team members
-    team = await db.team_members.find({}, {"_id": 0}).to_list(10)
-    
-    # Get active legal documents
-    legal_docs = await db.legal_documents.find({"is_active": True}, {"_id": 0, "content": 0}).to_list(10)
+    # Active legal documents, listed without their content
+    legal_docs = [
+        {key: value for key, value in doc.items() if key != "content"}
+        for doc in (await legal_cache.get()).values()
+    ]
     
     return {
         "gold_price_per_gram": settings["gold_price_per_gram"],
@@ -450,38 +2227,49 @@ async def get_public_settings():
         "ico_wallet_address": settings["ico_wallet_address"],
         "days_since_start": days_since_start,
         "offers": offers,
-        "team": team,
+        "team": await team_cache.get(),
         "legal_documents": legal_docs,
         "whitepaper_url": settings.get("whitepaper_url", "")
     }
 
+@api_router.get("/settings/public")
+async def get_public_settings(request: Request):
+    """Get public ICO settings"""
+    settings = await get_admin_settings()
+    ico_start = parse_iso_datetime(settings["ico_start_date"])
+    days_since_start = (datetime.now(timezone.utc) - ico_start).days
+    # The day count is the only part that changes without an admin write, so it keys the cache
+    body, etag, modified = await public_settings_responses.get(
+        days_since_start, lambda: build_public_settings(days_since_start)
+    )
+    return cached_json_response(request, body, etag, modified)
+
 @api_router.get("/team")
-async def get_team_members():
+async def get_team_members(request: Request):
     """Get all team members"""
-    team = await db.team_members.find({}, {"_id": 0}).to_list(10)
-    return team
+    body, etag, modified = await team_responses.get("team", team_cache.get)
+    return cached_json_response(request, body, etag, modified)
 
-@api_router.get("/legal/{slug}")
-async def get_legal_document(slug: str):
-    """Get a legal document by slug"""
-    doc = await db.legal_documents.find_one({"slug": slug, "is_active": True}, {"_id": 0})
+async def _get_legal_document(slug: str) -> dict:
+    doc = (await legal_cache.get()).get(slug)
     if not doc:
         raise HTTPException(status_code=404, detail="Document not found")
     return doc
 
-@api_router.post("/calculate-purchase", response_model=PurchaseCalculationResponse)
-async def calculate_purchase(data: PurchaseCalculation):
-    """Calculate PIO for a given USDT amount"""
-    settings = await get_admin_settings()
-    gold_price = settings["gold_price_per_gram"]
-    
-    base_pio = data.usdt_amount / gold_price
-    discount_percent, discount_tier = await get_applicable_discount(data.usdt_amount)
+@api_router.get("/legal/{slug}")
+async def get_legal_document(slug: str, request: Request):
+    """Get a legal document by slug"""
+    body, etag, modified = await legal_responses.get(slug, lambda: _get_legal_document(slug))
+    return cached_json_response(request, body, etag, modified)
+
+def quote_purchase(usdt_amount: float, gold_price: float, index: DiscountIndex, now: datetime) -> PurchaseCalculationResponse:
+    base_pio = usdt_amount / gold_price
+    discount_percent, discount_tier = index.lookup(usdt_amount, now)
     bonus_pio = base_pio * (discount_percent / 100)
     total_pio = base_pio + bonus_pio
     
     return PurchaseCalculationResponse(
-        usdt_amount=data.usdt_amount,
+        usdt_amount=usdt_amount,
         gold_price=gold_price,
         base_pio=round(base_pio, 8),
         discount_percent=discount_percent,
@@ -490,6 +2278,22 @@ async def calculate_purchase(data: PurchaseCalculation):
         discount_tier=discount_tier
     )
 
+@api_router.post("/calculate-purchase", response_model=PurchaseCalculationResponse)
+async def calculate_purchase(data: PurchaseCalculation):
+    """Calculate PIO for a given USDT amount"""
+    settings = await get_admin_settings()
+    index = await get_discount_index()
+    return quote_purchase(data.usdt_amount, settings["gold_price_per_gram"], index, datetime.now(timezone.utc))
+
+@api_router.post("/calculate-purchase/batch", response_model=List[PurchaseCalculationResponse])
+async def calculate_purchase_batch(data: PurchaseCalculationBatch):
+    """Calculate PIO for many USDT amounts against one settings/offers snapshot"""
+    settings = await get_admin_settings()
+    index = await get_discount_index()
+    gold_price = settings["gold_price_per_gram"]
+    now = datetime.now(timezone.utc)
+    return [quote_purchase(amount, gold_price, index, now) for amount in data.usdt_amounts]
+
 @api_router.post("/users/register", response_model=UserResponse)
 async def register_user(data: UserCreate):
     """Register or get existing user by wallet"""
@@ -510,18 +2314,33 @@ async def register_user(data: UserCreate):
         raise HTTPException(status_code=400, detail="Invalid referral code")
     
     referrer_id = referrer["id"]
+    ancestors = [referrer_id] + (await get_ancestors(referrer))[:len(REFERRAL_RATES) - 1]
     
     user = {
         "id": str(uuid.uuid4()),
         "wallet_address": wallet,
         "referral_code": generate_referral_code(),
         "referrer_id": referrer_id,
+        "ancestors": ancestors,
+        "direct_referrals": 0,
         "total_purchased_usdt": 0,
         "total_pio_received": 0,
         "created_at": datetime.now(timezone.utc).isoformat()
     }
     
-    await db.users.insert_one(user)
+    while True:
+        try:
+            await db.users.insert_one(user)
+            break
+        except DuplicateKeyError:
+            # A concurrent registration for the same wallet won; return the user it created
+            existing = await db.users.find_one({"wallet_address": wallet}, {"_id": 0})
+            if existing:
+                return UserResponse(**existing)
+            user.pop("_id", None)
+            user["referral_code"] = generate_referral_code()
+    await db.users.update_one({"id": referrer_id}, {"$inc": {"direct_referrals": 1}})
+    await bump_stats(total_users=1)
     return UserResponse(**user)
 
 @api_router.get("/users/{wallet_address}", response_model=UserResponse)
@@ -551,9 +2370,6 @@ async def get_user_referrals(wallet_address: str):
     # Get referrals where this user is the referrer
     referrals = await db.referrals.find({"referrer_id": user["id"]}, {"_id": 0}).sort("created_at", -1).to_list(100)
     
-    # Get referred users
-    referred_users = await db.users.find({"referrer_id": user["id"]}, {"_id": 0}).to_list(100)
-    
     # Calculate totals by level
     level_stats = {1: {"count": 0, "earnings": 0}, 2: {"count": 0, "earnings": 0}, 3: {"count": 0, "earnings": 0}}
     for ref in referrals:
@@ -562,21 +2378,31 @@ async def get_user_referrals(wallet_address: str):
             level_stats[level]["count"] += 1
             level_stats[level]["earnings"] += ref["reward_pio"]
     
-    total_earnings = sum(ref["reward_pio"] for ref in referrals if ref["status"] in ["approved", "paid"])
+    total_earnings = sum(ref["reward_pio"] for ref in referrals if ref["status"] in ["approved", "paying", "paid"])
     pending_earnings = sum(ref["reward_pio"] for ref in referrals if ref["status"] == "pending")
     
     return {
         "referral_code": user["referral_code"],
-        "total_referrals": len(referred_users),
+        "total_referrals": user.get("direct_referrals", 0),
         "level_stats": level_stats,
         "total_earnings_pio": round(total_earnings, 8),
         "pending_earnings_pio": round(pending_earnings, 8),
         "recent_referrals": referrals[:10]
     }
 
+ORDER_RECEIPT_PROJECTION = {"_id": 0, "id": 1, "wallet_address": 1, "usdt_tx_hash": 1, "status": 1, "total_pio": 1}
+
+def order_receipt_for(existing: dict, data: OrderCreate) -> dict:
+    """Answer a repeated submission with the order it already created"""
+    if existing["usdt_tx_hash"] != data.tx_hash:
+        raise HTTPException(status_code=422, detail="Idempotency-Key already used for a different order")
+    if existing["wallet_address"] != data.wallet_address.lower():
+        raise HTTPException(status_code=400, detail="Transaction already processed")
+    return {"order_id": existing["id"], "status": existing["status"], "total_pio": existing["total_pio"]}
+
 @api_router.post("/orders/create")
-async def create_order(data: OrderCreate, background_tasks: BackgroundTasks):
-    """Create a new purchase order"""
+async def create_order(data: OrderCreate, idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")):
+    """Create a new purchase order; repeating a request returns the original order"""
     settings = await get_admin_settings()
     
     if not settings["ico_active"]:
@@ -585,25 +2411,34 @@ async def create_order(data: OrderCreate, background_tasks: BackgroundTasks):
     if not settings["ico_wallet_address"]:
         raise HTTPException(status_code=400, detail="ICO wallet not configured")
     
-    # Check for duplicate tx hash
-    existing = await db.orders.find_one({"usdt_tx_hash": data.tx_hash})
-    if existing:
-        raise HTTPException(status_code=400, detail="Transaction already processed")
+    if idempotency_key:
+        previous = await db.orders.find_one({"idempotency_key": idempotency_key}, ORDER_RECEIPT_PROJECTION)
+        if previous:
+            return order_receipt_for(previous, data)
     
-    # Get or create user
+    # Get or create user in one atomic upsert
     wallet = data.wallet_address.lower()
-    user = await db.users.find_one({"wallet_address": wallet}, {"_id": 0})
-    if not user:
-        user = {
-            "id": str(uuid.uuid4()),
-            "wallet_address": wallet,
-            "referral_code": generate_referral_code(),
-            "referrer_id": None,
-            "total_purchased_usdt": 0,
-            "total_pio_received": 0,
-            "created_at": datetime.now(timezone.utc).isoformat()
-        }
-        await db.users.insert_one(user)
+    new_user = {
+        "id": str(uuid.uuid4()),
+        "wallet_address": wallet,
+        "referral_code": generate_referral_code(),
+        "referrer_id": None,
+        "ancestors": [],
+        "direct_referrals": 0,
+        "total_purchased_usdt": 0,
+        "total_pio_received": 0,
+        "created_at": datetime.now(timezone.utc).isoformat()
+    }
+    user = await db.users.find_one_and_update(
+        {"wallet_address": wallet},
+        {"$setOnInsert": new_user},
+        projection={"_id": 0, "id": 1},
+        upsert=True,
+        return_document=ReturnDocument.BEFORE
+    )
+    if user is None:
+        user = new_user
+        await bump_stats(total_users=1)
     
     gold_price = settings["gold_price_per_gram"]
     base_pio = data.usdt_amount / gold_price
@@ -626,8 +2461,28 @@ async def create_order(data: OrderCreate, background_tasks: BackgroundTasks):
         "status": "pending_verification",
         "created_at": datetime.now(timezone.utc).isoformat()
     }
+    if idempotency_key:
+        order["idempotency_key"] = idempotency_key
+    
+    # The unique usdt_tx_hash index makes this the single point of truth:
+    # concurrent submissions of one hash resolve to the same order
+    try:
+        existing = await db.orders.find_one_and_update(
+            {"usdt_tx_hash": data.tx_hash},
+            {"$setOnInsert": order},
+            projection=ORDER_RECEIPT_PROJECTION,
+            upsert=True,
+            return_document=ReturnDocument.BEFORE
+        )
+    except DuplicateKeyError:
+        # Lost an upsert race on the tx hash, or the key is bound to another order
+        existing = await db.orders.find_one({"usdt_tx_hash": data.tx_hash}, ORDER_RECEIPT_PROJECTION)
+        if not existing:
+            raise HTTPException(status_code=422, detail="Idempotency-Key already used for a different order")
+    if existing:
+        return order_receipt_for(existing, data)
     
-    await db.orders.insert_one(order)
+    await bump_stats(total_orders=1)
     
     # Create USDT transaction record
     usdt_tx = {
@@ -644,91 +2499,11 @@ async def create_order(data: OrderCreate, background_tasks: BackgroundTasks):
     }
     await db.transactions.insert_one(usdt_tx)
     
-    # Background task to verify and process
-    background_tasks.add_task(process_order, order["id"])
+    # Queue durable verification and processing
+    await enqueue_job("process_order", order["id"], {"order_id": order["id"]})
     
     return {"order_id": order["id"], "status": "pending_verification", "total_pio": round(total_pio, 8)}
 
-async def process_order(order_id: str):
-    """Background task to verify USDT and send PIO"""
-    await asyncio.sleep(5)  # Wait for blockchain confirmation
-    
-    order = await db.orders.find_one({"id": order_id}, {"_id": 0})
-    if not order:
-        return
-    
-    settings = await get_admin_settings()
-    
-    # Verify USDT transaction
-    verification = await verify_usdt_transaction(
-        order["usdt_tx_hash"],
-        order["usdt_amount"],
-        settings["ico_wallet_address"]
-    )
-    
-    if not verification["valid"]:
-        await db.orders.update_one(
-            {"id": order_id},
-            {"$set": {"status": "verification_failed", "error": verification.get("error")}}
-        )
-        await db.transactions.update_one(
-            {"order_id": order_id, "type": "usdt_payment"},
-            {"$set": {"status": "failed"}}
-        )
-        return
-    
-    # Update USDT transaction status
-    await db.transactions.update_one(
-        {"order_id": order_id, "type": "usdt_payment"},
-        {"$set": {"status": "confirmed"}}
-    )
-    
-    # Send PIO
-    pio_result = await send_pio_native(order["wallet_address"], order["total_pio"])
-    
-    if pio_result["success"]:
-        await db.orders.update_one(
-            {"id": order_id},
-            {"$set": {
-                "status": "completed",
-                "pio_tx_hash": pio_result["tx_hash"]
-            }}
-        )
-        
-        # Create PIO transaction record
-        pio_tx = {
-            "id": str(uuid.uuid4()),
-            "order_id": order_id,
-            "type": "pio_transfer",
-            "from_address": settings["ico_wallet_address"],
-            "to_address": order["wallet_address"],
-            "amount": order["total_pio"],
-            "tx_hash": pio_result["tx_hash"],
-            "chain": "piogold",
-            "status": "confirmed",
-            "created_at": datetime.now(timezone.utc).isoformat()
-        }
-        await db.transactions.insert_one(pio_tx)
-        
-        # Update user totals
-        await db.users.update_one(
-            {"id": order["user_id"]},
-            {"$inc": {
-                "total_purchased_usdt": order["usdt_amount"],
-                "total_pio_received": order["total_pio"]
-            }}
-        )
-        
-        # Calculate referral rewards
-        await calculate_referral_rewards(
-            order_id, order["user_id"], order["usdt_amount"], order["gold_price"]
-        )
-    else:
-        await db.orders.update_one(
-            {"id": order_id},
-            {"$set": {"status": "pio_transfer_failed", "error": pio_result.get("error")}}
-        )
-
 @api_router.get("/orders/{order_id}/status")
 async def get_order_status(order_id: str):
     """Get order status"""
@@ -740,18 +2515,27 @@ async def get_order_status(order_id: str):
 # ==================== ADMIN ENDPOINTS ====================
 
 @api_router.post("/admin/login")
-async def admin_login(data: AdminLogin):
+async def admin_login(data: AdminLogin, request: Request):
     """Admin login"""
+    await throttle_login(data.username, client_ip(request))
     admin = await db.admins.find_one({"username": data.username}, {"_id": 0})
     if not admin:
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
-    if not verify_password(data.password, admin["password_hash"]):
+    if not await verify_password(data.password, admin["password_hash"]):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
     token = create_token({"sub": admin["id"], "username": admin["username"]})
     return {"access_token": token, "token_type": "bearer"}
 
+@api_router.post("/admin/logout")
+async def admin_logout(credentials: HTTPAuthorizationCredentials = Depends(security), admin = Depends(get_current_admin)):
+    """Revoke the token used for this request"""
+    payload = decode_admin_token(credentials)
+    if payload.get("jti"):
+        await revoke_token(payload)
+    return {"message": "Logged out"}
+
 @api_router.post("/admin/setup")
 async def setup_admin(data: AdminCreate):
     """Create first admin (only works if no admins exist)"""
@@ -763,7 +2547,7 @@ async def setup_admin(data: AdminCreate):
         "id": str(uuid.uuid4()),
         "username": data.username,
         "email": data.email,
-        "password_hash": hash_password(data.password),
+        "password_hash": await hash_password(data.password),
         "created_at": datetime.now(timezone.utc).isoformat()
     }
     await db.admins.insert_one(admin)
@@ -784,6 +2568,7 @@ async def setup_admin(data: AdminCreate):
             **offer_data
         }
         await db.offers.insert_one(offer)
+    await refresh_discount_index()
     
     token = create_token({"sub": admin["id"], "username": admin["username"]})
     return {"message": "Admin created", "access_token": token, "token_type": "bearer"}
@@ -817,22 +2602,26 @@ async def update_admin_settings(data: AdminSettingsUpdate, admin = Depends(get_c
     if data.encrypted_private_key is not None:
         # Encrypt the private key before storing
         update_data["encrypted_private_key"] = encrypt_private_key(data.encrypted_private_key)
+        ico_signer.clear()
     if data.whitepaper_url is not None:
         update_data["whitepaper_url"] = data.whitepaper_url
     
     await db.admin_settings.update_one({}, {"$set": update_data})
+    await invalidate_cache(settings_cache)
     return {"message": "Settings updated"}
 
 @api_router.post("/admin/ico/pause")
 async def pause_ico(admin = Depends(get_current_admin)):
     """Emergency ICO pause"""
     await db.admin_settings.update_one({}, {"$set": {"ico_active": False}})
+    await invalidate_cache(settings_cache)
     return {"message": "ICO paused"}
 
 @api_router.post("/admin/ico/resume")
 async def resume_ico(admin = Depends(get_current_admin)):
     """Resume ICO"""
     await db.admin_settings.update_one({}, {"$set": {"ico_active": True}})
+    await invalidate_cache(settings_cache)
     return {"message": "ICO resumed"}
 
 @api_router.get("/admin/offers")
@@ -854,6 +2643,7 @@ async def create_offer(data: OfferCreate, admin = Depends(get_current_admin)):
         "created_at": datetime.now(timezone.utc).isoformat()
     }
     await db.offers.insert_one(offer)
+    await refresh_discount_index()
     return offer
 
 @api_router.put("/admin/offers/{offer_id}")
@@ -871,6 +2661,7 @@ async def update_offer(offer_id: str, data: OfferCreate, admin = Depends(get_cur
     )
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Offer not found")
+    await refresh_discount_index()
     return {"message": "Offer updated"}
 
 @api_router.delete("/admin/offers/{offer_id}")
@@ -879,34 +2670,155 @@ async def delete_offer(offer_id: str, admin = Depends(get_current_admin)):
     result = await db.offers.delete_one({"id": offer_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Offer not found")
+    await refresh_discount_index()
     return {"message": "Offer deleted"}
 
 @api_router.get("/admin/orders")
-async def get_all_orders(admin = Depends(get_current_admin), status: Optional[str] = None, limit: int = 100):
+async def get_all_orders(
+    response: Response,
+    admin = Depends(get_current_admin),
+    status: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
+    wallet: Optional[str] = None,
+    created_from: Optional[str] = None,
+    created_to: Optional[str] = None,
+    min_amount: Optional[float] = None,
+    max_amount: Optional[float] = None
+):
     """Get all orders"""
     query = {}
     if status:
         query["status"] = status
-    orders = await db.orders.find(query, {"_id": 0}).sort("created_at", -1).to_list(limit)
-    return orders
+    if wallet:
+        query["wallet_address"] = wallet.lower()
+    range_filter(query, "created_at", created_from, created_to)
+    range_filter(query, "usdt_amount", min_amount, max_amount)
+    return await find_page(db.orders, query, "created_at", limit, response, cursor, projection=parse_projection(fields))
+
+@api_router.post("/admin/orders/{order_id}/retry-payout")
+async def retry_order_payout(order_id: str, admin = Depends(get_current_admin)):
+    """Send PIO again for an order whose transfer failed"""
+    result = await db.orders.update_one(
+        {"id": order_id, "status": "pio_transfer_failed"},
+        {"$set": {"status": "verified"}, "$unset": {"error": "", "pio_tx_hash": ""}}
+    )
+    if result.matched_count == 0:
+        raise HTTPException(status_code=404, detail="Failed order not found")
+    await requeue_job("process_order", order_id, {"order_id": order_id})
+    return {"message": "Payout requeued"}
 
 @api_router.get("/admin/transactions")
-async def get_all_transactions(admin = Depends(get_current_admin), chain: Optional[str] = None, limit: int = 100):
+async def get_all_transactions(
+    response: Response,
+    admin = Depends(get_current_admin),
+    chain: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
+    wallet: Optional[str] = None,
+    created_from: Optional[str] = None,
+    created_to: Optional[str] = None,
+    min_amount: Optional[float] = None,
+    max_amount: Optional[float] = None
+):
     """Get all transactions"""
     query = {}
     if chain:
         query["chain"] = chain
-    transactions = await db.transactions.find(query, {"_id": 0}).sort("created_at", -1).to_list(limit)
-    return transactions
+    if wallet:
+        query["$or"] = [{"from_address": wallet.lower()}, {"to_address": wallet.lower()}]
+    range_filter(query, "created_at", created_from, created_to)
+    range_filter(query, "amount", min_amount, max_amount)
+    return await find_page(db.transactions, query, "created_at", limit, response, cursor, projection=parse_projection(fields))
 
 @api_router.get("/admin/referrals")
-async def get_all_referrals(admin = Depends(get_current_admin), status: Optional[str] = None, limit: int = 100):
-    """Get all referrals"""
+async def get_all_referrals(
+    response: Response,
+    admin = Depends(get_current_admin),
+    status: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
+    wallet: Optional[str] = None,
+    created_from: Optional[str] = None,
+    created_to: Optional[str] = None,
+    min_amount: Optional[float] = None,
+    max_amount: Optional[float] = None
+):
+    """Get all referrals; wallet selects the referrer and amounts are purchase USDT"""
+    query = {}
+    if status:
+        query["status"] = status
+    if wallet:
+        referrer = await db.users.find_one({"wallet_address": wallet.lower()}, {"_id": 0, "id": 1})
+        if not referrer:
+            return []
+        query["referrer_id"] = referrer["id"]
+    range_filter(query, "created_at", created_from, created_to)
+    range_filter(query, "usdt_amount", min_amount, max_amount)
+    return await find_page(db.referrals, query, "created_at", limit, response, cursor, projection=parse_projection(fields))
+
+EXPORT_COLUMNS = {
+    "orders": ["id", "user_id", "wallet_address", "usdt_amount", "gold_price", "base_pio", "discount_percent",
+               "bonus_pio", "total_pio", "usdt_tx_hash", "pio_tx_hash", "status", "created_at"],
+    "transactions": ["id", "order_id", "type", "from_address", "to_address", "amount", "tx_hash", "chain",
+                     "status", "created_at"],
+    "referrals": ["id", "referrer_id", "referee_id", "order_id", "level", "usdt_amount", "reward_usdt",
+                  "reward_pio", "status", "created_at"],
+}
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', '1000'))
+
+async def export_rows(cursor, columns: list, fmt: str):
+    """Yield one encoded chunk per cursor batch so memory stays flat however large the export"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if fmt == "csv":
+        writer.writerow(columns)
+    rows = 0
+    async for doc in cursor:
+        if fmt == "csv":
+            writer.writerow(["" if doc.get(column) is None else doc.get(column) for column in columns])
+        else:
+            buffer.write(json.dumps(doc, default=str) + "\n")
+        rows += 1
+        if rows % EXPORT_BATCH_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+@api_router.get("/admin/export/{collection}")
+async def export_collection(
+    collection: str,
+    admin = Depends(get_current_admin),
+    format: str = "csv",
+    status: Optional[str] = None,
+    created_from: Optional[str] = None,
+    created_to: Optional[str] = None
+):
+    """Stream a collection as CSV or NDJSON in created_at order"""
+    if collection not in EXPORT_COLUMNS:
+        raise HTTPException(status_code=404, detail="Unknown export")
+    if format not in ("csv", "ndjson"):
+        raise HTTPException(status_code=400, detail="format must be csv or ndjson")
+    
     query = {}
     if status:
         query["status"] = status
-    referrals = await db.referrals.find(query, {"_id": 0}).sort("created_at", -1).to_list(limit)
-    return referrals
+    range_filter(query, "created_at", created_from, created_to)
+    columns = EXPORT_COLUMNS[collection]
+    cursor = db[collection].find(query, {"_id": 0, **{column: 1 for column in columns}}).sort(
+        [("created_at", 1), ("id", 1)]
+    ).batch_size(EXPORT_BATCH_SIZE)
+    
+    filename = f"{collection}-{datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S')}.{format}"
+    return StreamingResponse(
+        export_rows(cursor, columns, format),
+        media_type="text/csv" if format == "csv" else "application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
 
 @api_router.put("/admin/referrals/{referral_id}")
 async def update_referral_status(referral_id: str, data: ReferralPayoutUpdate, admin = Depends(get_current_admin)):
@@ -914,64 +2826,257 @@ async def update_referral_status(referral_id: str, data: ReferralPayoutUpdate, a
     if data.status not in ["approved", "paid", "rejected"]:
         raise HTTPException(status_code=400, detail="Invalid status")
     
-    result = await db.referrals.update_one(
-        {"id": referral_id},
-        {"$set": {"status": data.status, "updated_at": datetime.now(timezone.utc).isoformat()}}
+    # A paying referral belongs to a bulk payout whose transfer is in flight; its outcome settles it
+    previous = await db.referrals.find_one_and_update(
+        {"id": referral_id, "status": {"$ne": "paying"}},
+        {"$set": {"status": data.status, "updated_at": datetime.now(timezone.utc).isoformat()}},
+        projection={"_id": 0, "status": 1, "reward_pio": 1}
     )
-    if result.matched_count == 0:
+    if previous is None:
+        if await db.referrals.find_one({"id": referral_id}, {"_id": 0, "id": 1}):
+            raise HTTPException(status_code=409, detail="Referral is being paid")
         raise HTTPException(status_code=404, detail="Referral not found")
+    if previous["status"] == "pending":
+        await bump_stats(pending_referrals=-1, pending_referral_pio=-previous["reward_pio"])
     return {"message": f"Referral status updated to {data.status}"}
 
+REFERRAL_PAYOUT_BATCH = int(os.environ.get('REFERRAL_PAYOUT_BATCH', '50'))  # transfers in flight at once
+REFERRAL_CLAIM_TIMEOUT = float(os.environ.get('REFERRAL_CLAIM_TIMEOUT', '600'))  # seconds before an unsent claim is released
+
+async def release_referral_claim(batch_id: str, referrer_id: str, restore_stats: bool = False):
+    """Return a referrer's claimed rewards to the status they were claimed from"""
+    now = datetime.now(timezone.utc).isoformat()
+    selector = {"payout_batch": batch_id, "referrer_id": referrer_id, "status": "paying"}
+    if restore_stats:
+        pending = await db.referrals.find(dict(selector, claimed_from="pending"), {"_id": 0, "reward_pio": 1}).to_list(None)
+    for status in ("pending", "approved"):
+        await db.referrals.update_many(
+            dict(selector, claimed_from=status),
+            {"$set": {"status": status, "updated_at": now},
+             "$unset": {"payout_batch": "", "claimed_from": "", "payout_tx_hash": ""}}
+        )
+    if restore_stats and pending:
+        await bump_stats(pending_referrals=len(pending), pending_referral_pio=sum(r["reward_pio"] for r in pending))
+
+async def handle_referral_payout_outcome(payout: dict, status: str):
+    """Mark a referrer's rewards paid once their transfer is mined, or release them if it never lands"""
+    batch_id, referrer_id = payout["reference"].split(":", 1)
+    if status == "confirmed":
+        await db.referrals.update_many(
+            {"payout_batch": batch_id, "referrer_id": referrer_id, "status": "paying"},
+            {"$set": {"status": "paid", "payout_tx_hash": payout["tx_hash"],
+                      "updated_at": datetime.now(timezone.utc).isoformat()},
+             "$unset": {"claimed_from": ""}}
+        )
+    else:
+        await release_referral_claim(batch_id, referrer_id, restore_stats=True)
+        logger.error(f"Referral payout to {referrer_id} in batch {batch_id} {status}; rewards released")
+
+PAYOUT_OUTCOME_HANDLERS["referral_payout"] = handle_referral_payout_outcome
+
+async def release_stale_referral_claims():
+    """Release claims left in paying by a run that died before their transfer was submitted"""
+    cutoff = (datetime.now(timezone.utc) - timedelta(seconds=REFERRAL_CLAIM_TIMEOUT)).isoformat()
+    claims = await db.referrals.aggregate([
+        {"$match": {"status": "paying", "updated_at": {"$lt": cutoff}}},
+        {"$group": {"_id": {"batch": "$payout_batch", "referrer": "$referrer_id"}}}
+    ]).to_list(None)
+    for claim in claims:
+        batch_id, referrer_id = claim["_id"]["batch"], claim["_id"]["referrer"]
+        payout = await db.payouts.find_one(
+            {"reference": f"{batch_id}:{referrer_id}", "kind": "referral_payout", "status": {"$in": ["submitted", "confirmed"]}},
+            {"_id": 0}
+        )
+        if payout is None:
+            await release_referral_claim(batch_id, referrer_id)
+            logger.warning(f"Released stale referral claim for {referrer_id} in batch {batch_id}")
+        elif payout["status"] == "confirmed":
+            await handle_referral_payout_outcome(payout, "confirmed")
+
+async def pay_referral_batch(batch_id: str, group: list, wallets: dict) -> list:
+    """Submit one transfer per referrer concurrently, then record the batch's transfers in one bulk write.
+
+    Referrals stay in paying until the payout monitor sees the transfer mined.
+    """
+    payable = [g for g in group if g["_id"] in wallets]
+    results = await asyncio.gather(*[
+        send_pio_native(wallets[g["_id"]], g["reward_pio"], f"{batch_id}:{g['_id']}", "referral_payout") for g in payable
+    ])
+    now = datetime.now(timezone.utc).isoformat()
+    writes, transactions, transfers = [], [], []
+    for g, result in zip(payable, results):
+        selector = {"payout_batch": batch_id, "referrer_id": g["_id"]}
+        transfer = {"referrer_id": g["_id"], "wallet_address": wallets[g["_id"]],
+                    "referrals": g["count"], "reward_pio": g["reward_pio"]}
+        if result["success"]:
+            writes.append(UpdateMany(selector, {"$set": {"payout_tx_hash": result["tx_hash"], "updated_at": now}}))
+            transactions.append({
+                "id": str(uuid.uuid4()),
+                "order_id": None,
+                "type": "referral_payout",
+                "from_address": None,
+                "to_address": wallets[g["_id"]],
+                "amount": g["reward_pio"],
+                "tx_hash": result["tx_hash"],
+                "chain": "piogold",
+                "status": "pending",
+                "created_at": now
+            })
+            transfer["tx_hash"] = result["tx_hash"]
+        else:
+            # Release the claim so the rewards can be paid by a later run
+            await release_referral_claim(batch_id, g["_id"])
+            transfer["error"] = result["error"]
+        transfers.append(transfer)
+    for g in group:
+        if g["_id"] not in wallets:
+            await release_referral_claim(batch_id, g["_id"])
+            transfers.append({"referrer_id": g["_id"], "wallet_address": None, "referrals": g["count"],
+                              "reward_pio": g["reward_pio"], "error": "Referrer wallet not found"})
+    if writes:
+        await db.referrals.bulk_write(writes, ordered=False)
+    if transactions:
+        await db.transactions.insert_many(transactions)
+    return transfers
+
+@api_router.post("/admin/referrals/payout")
+async def bulk_pay_referrals(data: ReferralBulkPayout, admin = Depends(get_current_admin)):
+    """Pay every matching referral on chain with one PIO transfer per referrer wallet"""
+    if data.status not in ["pending", "approved"]:
+        raise HTTPException(status_code=400, detail="Invalid status")
+    query = {"status": data.status}
+    if data.referrer_id:
+        query["referrer_id"] = data.referrer_id
+    range_filter(query, "created_at", data.created_from, data.created_to)
+    
+    if not data.dry_run and await get_ico_account() is None:
+        raise HTTPException(status_code=400, detail="Admin private key not configured")
+    
+    batch_id = str(uuid.uuid4())
+    if not data.dry_run:
+        # Claim the rewards first so concurrent runs can never pay the same referral twice
+        claimed = await db.referrals.update_many(query, {"$set": {
+            "status": "paying", "payout_batch": batch_id, "claimed_from": data.status,
+            "updated_at": datetime.now(timezone.utc).isoformat()
+        }})
+        if claimed.modified_count == 0:
+            return {"batch_id": batch_id, "referrers": 0, "paid": 0, "failed": 0, "total_pio": 0, "transfers": []}
+        query = {"payout_batch": batch_id}
+    
+    groups = await db.referrals.aggregate([
+        {"$match": query},
+        {"$group": {"_id": "$referrer_id", "count": {"$sum": 1}, "reward_pio": {"$sum": "$reward_pio"}}}
+    ]).to_list(None)
+    for g in groups:
+        g["reward_pio"] = round(g["reward_pio"], 8)
+    wallets = {
+        user["id"]: user["wallet_address"]
+        async for user in db.users.find({"id": {"$in": [g["_id"] for g in groups]}}, {"_id": 0, "id": 1, "wallet_address": 1})
+    }
+    if data.dry_run:
+        transfers = [{"referrer_id": g["_id"], "wallet_address": wallets.get(g["_id"]),
+                      "referrals": g["count"], "reward_pio": g["reward_pio"]} for g in groups]
+        return {"batch_id": None, "referrers": len(groups), "total_pio": round(sum(g["reward_pio"] for g in groups), 8),
+                "transfers": transfers}
+    
+    transfers = []
+    for start in range(0, len(groups), REFERRAL_PAYOUT_BATCH):
+        transfers += await pay_referral_batch(batch_id, groups[start:start + REFERRAL_PAYOUT_BATCH], wallets)
+    
+    paid = [t for t in transfers if "tx_hash" in t]
+    if data.status == "pending" and paid:
+        await bump_stats(pending_referrals=-sum(t["referrals"] for t in paid),
+                         pending_referral_pio=-sum(t["reward_pio"] for t in paid))
+    logger.info(f"Referral payout {batch_id}: {len(paid)}/{len(transfers)} referrer(s) paid")
+    return {
+        "batch_id": batch_id,
+        "referrers": len(transfers),
+        "paid": len(paid),
+        "failed": len(transfers) - len(paid),
+        "total_pio": round(sum(t["reward_pio"] for t in paid), 8),
+        "transfers": transfers
+    }
+
 @api_router.get("/admin/stats")
 async def get_stats(admin = Depends(get_current_admin)):
     """Get dashboard statistics"""
-    total_users = await db.users.count_documents({})
-    total_orders = await db.orders.count_documents({})
-    completed_orders = await db.orders.count_documents({"status": "completed"})
-    
-    # Aggregate totals
-    pipeline = [
-        {"$match": {"status": "completed"}},
-        {"$group": {
-            "_id": None,
-            "total_usdt": {"$sum": "$usdt_amount"},
-            "total_pio": {"$sum": "$total_pio"}
-        }}
-    ]
-    agg_result = await db.orders.aggregate(pipeline).to_list(1)
-    totals = agg_result[0] if agg_result else {"total_usdt": 0, "total_pio": 0}
-    
-    # Pending referrals
-    pending_referrals = await db.referrals.count_documents({"status": "pending"})
-    pending_referral_amount = 0
-    pending_refs = await db.referrals.find({"status": "pending"}, {"_id": 0}).to_list(1000)
-    for ref in pending_refs:
-        pending_referral_amount += ref["reward_pio"]
+    stats = await db.stats.find_one({"_id": STATS_ID})
+    if not stats or "reconciled_at" not in stats:
+        stats = await reconcile_stats()
     
     return {
-        "total_users": total_users,
-        "total_orders": total_orders,
-        "completed_orders": completed_orders,
-        "total_usdt_raised": round(totals.get("total_usdt", 0), 2),
-        "total_pio_sold": round(totals.get("total_pio", 0), 8),
-        "pending_referrals": pending_referrals,
-        "pending_referral_pio": round(pending_referral_amount, 8)
+        "total_users": stats.get("total_users", 0),
+        "total_orders": stats.get("total_orders", 0),
+        "completed_orders": stats.get("completed_orders", 0),
+        "total_usdt_raised": round(stats.get("total_usdt_raised", 0), 2),
+        "total_pio_sold": round(stats.get("total_pio_sold", 0), 8),
+        "pending_referrals": stats.get("pending_referrals", 0),
+        "pending_referral_pio": round(stats.get("pending_referral_pio", 0), 8)
     }
 
+USER_SORT_FIELDS = ("created_at", "direct_referrals", "total_purchased_usdt")
+
 @api_router.get("/admin/users")
-async def get_all_users(admin = Depends(get_current_admin), limit: int = 100):
+async def get_all_users(
+    response: Response,
+    admin = Depends(get_current_admin),
+    limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    sort_by: str = "created_at",
+    sort_order: str = "desc",
+    wallet: Optional[str] = None,
+    min_direct_referrals: Optional[int] = None,
+    min_total_purchased: Optional[float] = None
+):
     """Get all users with summary stats"""
-    users = await db.users.find({}, {"_id": 0}).sort("created_at", -1).to_list(limit)
-    
-    # Add direct referral count for each user
-    for user in users:
-        direct_count = await db.users.count_documents({"referrer_id": user["id"]})
-        user["direct_referrals"] = direct_count
+    if sort_by not in USER_SORT_FIELDS:
+        raise HTTPException(status_code=400, detail=f"sort_by must be one of {', '.join(USER_SORT_FIELDS)}")
+    if sort_order not in ("asc", "desc"):
+        raise HTTPException(status_code=400, detail="sort_order must be asc or desc")
     
-    return users
+    query = {}
+    if wallet:
+        # Wallets are stored lowercase, so an anchored prefix match can use the index
+        query["wallet_address"] = {"$regex": f"^{re.escape(wallet.lower())}"}
+    if min_direct_referrals is not None:
+        query["direct_referrals"] = {"$gte": min_direct_referrals}
+    if min_total_purchased is not None:
+        query["total_purchased_usdt"] = {"$gte": min_total_purchased}
+    
+    # direct_referrals is a counter kept on each user, maintained by register_user
+    return await find_page(db.users, query, sort_by, limit, response, cursor, sort_order == "desc")
+
+async def get_team_counts(user_id: str) -> dict:
+    """Count a user's downline per level in one aggregation over the ancestors index"""
+    pipeline = [
+        {"$match": {"ancestors": user_id}},
+        {"$group": {"_id": {"$indexOfArray": ["$ancestors", user_id]}, "count": {"$sum": 1}}}
+    ]
+    counts = {level: 0 for level in range(1, len(REFERRAL_RATES) + 1)}
+    async for doc in db.users.aggregate(pipeline):
+        counts[doc["_id"] + 1] = doc["count"]
+    return counts
+
+async def get_team_members(user_id: str, level: int, skip: int = 0, limit: int = 100) -> list:
+    """One page of the users exactly `level` steps below user_id"""
+    # The plain ancestors match lets the multikey index narrow the scan before the positional check
+    return await db.users.find(
+        {"ancestors": user_id, f"ancestors.{level - 1}": user_id}, {"_id": 0}
+    ).sort("created_at", -1).skip(skip).limit(limit).to_list(limit)
+
+@api_router.get("/admin/users/{user_id}/team/{level}")
+async def get_user_team_level(user_id: str, level: int, admin = Depends(get_current_admin),
+                              skip: int = Query(0, ge=0), limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE)):
+    """Get one page of a user's team at a given level"""
+    if not 1 <= level <= len(REFERRAL_RATES):
+        raise HTTPException(status_code=400, detail="Invalid level")
+    counts = await get_team_counts(user_id)
+    members = await get_team_members(user_id, level, skip, limit)
+    return {"level": level, "count": counts[level], "skip": skip, "limit": limit, "members": members}
 
 @api_router.get("/admin/users/{user_id}/details")
-async def get_user_details(user_id: str, admin = Depends(get_current_admin)):
+async def get_user_details(user_id: str, admin = Depends(get_current_admin),
+                           team_limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE)):
     """Get detailed user info with team and earnings"""
     user = await db.users.find_one({"id": user_id}, {"_id": 0})
     if not user:
@@ -980,20 +3085,13 @@ async def get_user_details(user_id: str, admin = Depends(get_current_admin)):
     # Get user's orders/purchases
     orders = await db.orders.find({"user_id": user_id}, {"_id": 0}).sort("created_at", -1).to_list(100)
     
-    # Get direct team (Level 1)
-    direct_team = await db.users.find({"referrer_id": user_id}, {"_id": 0}).to_list(100)
-    
-    # Get Level 2 team
-    level2_team = []
-    for member in direct_team:
-        l2_members = await db.users.find({"referrer_id": member["id"]}, {"_id": 0}).to_list(100)
-        level2_team.extend(l2_members)
-    
-    # Get Level 3 team
-    level3_team = []
-    for member in level2_team:
-        l3_members = await db.users.find({"referrer_id": member["id"]}, {"_id": 0}).to_list(100)
-        level3_team.extend(l3_members)
+    # Team counts per level plus the first page of members at each level
+    team_counts, direct_team, level2_team, level3_team = await asyncio.gather(
+        get_team_counts(user_id),
+        get_team_members(user_id, 1, limit=team_limit),
+        get_team_members(user_id, 2, limit=team_limit),
+        get_team_members(user_id, 3, limit=team_limit)
+    )
     
     # Get referral earnings
     referral_earnings = await db.referrals.find({"referrer_id": user_id}, {"_id": 0}).sort("created_at", -1).to_list(100)
@@ -1020,18 +3118,18 @@ async def get_user_details(user_id: str, admin = Depends(get_current_admin)):
         "orders": orders,
         "team": {
             "level1": {
-                "count": len(direct_team),
+                "count": team_counts[1],
                 "members": direct_team
             },
             "level2": {
-                "count": len(level2_team),
+                "count": team_counts[2],
                 "members": level2_team
             },
             "level3": {
-                "count": len(level3_team),
+                "count": team_counts[3],
                 "members": level3_team
             },
-            "total_team": len(direct_team) + len(level2_team) + len(level3_team)
+            "total_team": sum(team_counts.values())
         },
         "earnings": {
             "level1": round(level_earnings[1], 8),
@@ -1044,6 +3142,68 @@ async def get_user_details(user_id: str, admin = Depends(get_current_admin)):
         }
     }
 
+@api_router.get("/admin/system/stats")
+async def get_system_stats(admin = Depends(get_current_admin)):
+    """Get in-process cache and worker statistics"""
+    return {
+        "caches": {name: cache.stats() for name, cache in CACHES.items()},
+        "admin_principals": admin_principals.stats(),
+        "responses": {
+            "settings_public": public_settings_responses.stats(),
+            "team": team_responses.stats(),
+            "legal": legal_responses.stats()
+        },
+        "password_pool": password_pool,
+        "payment_scanner": scanner_status,
+        "job_queue": await get_job_queue_stats(),
+        "payouts": {**payout_engine.stats(), "signer_builds": ico_signer.builds},
+        "discount_index": {
+            "tiers": _discount_index.tier_count if _discount_index else 0,
+            "boundaries": len(_discount_index.points) if _discount_index else 0
+        }
+    }
+
+@api_router.get("/admin/jobs")
+async def get_jobs(admin = Depends(get_current_admin), status: Optional[str] = "dead", limit: int = 100):
+    """Get background jobs, dead-lettered ones by default"""
+    query = {}
+    if status:
+        query["status"] = status
+    jobs = await db.jobs.find(query, {"_id": 0}).sort("run_at", -1).to_list(limit)
+    return jobs
+
+@api_router.post("/admin/jobs/{job_id}/retry")
+async def retry_job(job_id: str, admin = Depends(get_current_admin)):
+    """Move a dead-lettered job back onto the queue"""
+    result = await db.jobs.update_one(
+        {"id": job_id, "status": "dead"},
+        {"$set": {"status": "queued", "attempts": 0, "run_at": datetime.now(timezone.utc)}}
+    )
+    if result.matched_count == 0:
+        raise HTTPException(status_code=404, detail="Dead job not found")
+    job_wakeup.set()
+    return {"message": "Job requeued"}
+
+@api_router.get("/admin/system/indexes")
+async def get_system_indexes(admin = Depends(get_current_admin)):
+    """Report missing and unused indexes per collection"""
+    return await get_index_report()
+
+SLOW_QUERY_ORDERS = ("total_ms", "max_ms", "avg_ms", "count", "slow_count")
+
+@api_router.get("/admin/system/slow-queries")
+async def get_slow_queries(admin = Depends(get_current_admin), limit: int = 20, order_by: str = "total_ms"):
+    """Top query shapes seen by this worker, with values redacted"""
+    if order_by not in SLOW_QUERY_ORDERS:
+        raise HTTPException(status_code=400, detail=f"order_by must be one of {', '.join(SLOW_QUERY_ORDERS)}")
+    return {"threshold_ms": SLOW_QUERY_MS, "queries": slow_query_monitor.top(limit, order_by)}
+
+@api_router.delete("/admin/system/slow-queries")
+async def reset_slow_queries(admin = Depends(get_current_admin)):
+    """Clear the collected query shapes"""
+    slow_query_monitor.reset()
+    return {"message": "Slow query statistics cleared"}
+
 # ==================== TEAM MANAGEMENT ====================
 
 @api_router.get("/admin/team")
@@ -1068,6 +3228,7 @@ async def create_team_member(data: TeamMemberCreate, admin = Depends(get_current
                 "updated_at": datetime.now(timezone.utc).isoformat()
             }}
         )
+        await invalidate_cache(team_cache)
         return {"message": f"{data.role} updated"}
     else:
         # Create new
@@ -1079,6 +3240,7 @@ async def create_team_member(data: TeamMemberCreate, admin = Depends(get_current
             "created_at": datetime.now(timezone.utc).isoformat()
         }
         await db.team_members.insert_one(member)
+        await invalidate_cache(team_cache)
         return {"message": f"{data.role} added"}
 
 @api_router.delete("/admin/team/{role}")
@@ -1087,6 +3249,7 @@ async def delete_team_member(role: str, admin = Depends(get_current_admin)):
     result = await db.team_members.delete_one({"role": role})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Team member not found")
+    await invalidate_cache(team_cache)
     return {"message": f"{role} deleted"}
 
 # ==================== LEGAL DOCUMENTS ====================
@@ -1112,6 +3275,7 @@ async def create_legal_document(data: LegalDocumentCreate, admin = Depends(get_c
                 "updated_at": datetime.now(timezone.utc).isoformat()
             }}
         )
+        await invalidate_cache(legal_cache)
         return {"message": f"Document '{data.slug}' updated"}
     else:
         doc = {
@@ -1124,6 +3288,7 @@ async def create_legal_document(data: LegalDocumentCreate, admin = Depends(get_c
             "updated_at": datetime.now(timezone.utc).isoformat()
         }
         await db.legal_documents.insert_one(doc)
+        await invalidate_cache(legal_cache)
         return {"message": f"Document '{data.slug}' created"}
 
 @api_router.delete("/admin/legal/{slug}")
@@ -1132,6 +3297,7 @@ async def delete_legal_document(slug: str, admin = Depends(get_current_admin)):
     result = await db.legal_documents.delete_one({"slug": slug})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Document not found")
+    await invalidate_cache(legal_cache)
     return {"message": f"Document '{slug}' deleted"}
 
 # Include the router in the main app
@@ -1143,8 +3309,91 @@ app.add_middleware(
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[NEXT_CURSOR_HEADER],
 )
 
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    started = time.perf_counter()
+    current_route.set(f"{request.method} {request.url.path}")
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # Label by route template so ids in paths don't explode the series count
+        route = request.scope.get("route")
+        REQUEST_LATENCY.labels(request.method, route.path if route else "unmatched", str(status)).observe(
+            time.perf_counter() - started
+        )
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Prometheus scrape endpoint; nginx only proxies /api, so this stays internal"""
+    jobs = await get_job_queue_stats()
+    for status in ("queued", "running", "dead"):
+        QUEUE_DEPTH.labels(f"jobs_{status}").set(jobs.get(status, 0))
+    QUEUE_DEPTH.labels("payouts_unconfirmed").set(await db.payouts.count_documents({"status": "submitted"}))
+    QUEUE_DEPTH.labels("password_waiting").set(password_pool["waiting"])
+    if scanner_status["head"] is not None and scanner_status["last_block"] is not None:
+        QUEUE_DEPTH.labels("scanner_blocks_behind").set(scanner_status["head"] - scanner_status["last_block"])
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+running_tasks: List[asyncio.Task] = []
+
+async def sync_payout_nonce_at_startup():
+    try:
+        account = await get_ico_account()
+        if account:
+            nonce = await payout_engine.sync_nonce(account.address)
+            logger.info(f"Payout nonce synced to {nonce} for {account.address}")
+    except Exception as e:
+        # Not fatal: the first payout syncs again on failure
+        logger.error(f"Payout nonce sync failed: {e}")
+
+async def open_rpc_session():
+    """Share one keep-alive connection pool between both chains' providers"""
+    global rpc_session
+    rpc_session = aiohttp.ClientSession(
+        raise_for_status=True,
+        connector=aiohttp.TCPConnector(limit=RPC_POOL_SIZE, keepalive_timeout=RPC_KEEPALIVE)
+    )
+    for w3 in (bsc_w3, piogold_w3):
+        await w3.provider.cache_async_session(rpc_session)
+
+def start_task(source: str, coro):
+    """Run a background loop with its queries attributed to source"""
+    context = contextvars.copy_context()
+    context.run(current_route.set, source)
+    running_tasks.append(asyncio.create_task(coro, context=context))
+
+@app.on_event("startup")
+async def start_background_workers():
+    slow_query_monitor.loop = asyncio.get_running_loop()
+    current_route.set("startup")
+    await ensure_indexes()
+    await open_rpc_session()
+    await poll_cache_versions()
+    start_task("cache_sync", sync_cache_versions())
+    start_task("health_monitor", run_health_monitor())
+    await recover_pending_orders()
+    await release_stale_referral_claims()
+    await sync_payout_nonce_at_startup()
+    start_task("payout_monitor", payout_engine.run_monitor())
+    start_task("stats_reconciler", run_stats_reconciler())
+    for _ in range(JOB_WORKERS):
+        start_task("job_worker", job_worker())
+    if PAYMENT_SCANNER_ENABLED:
+        start_task("payment_scanner", run_payment_scanner())
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    for task in running_tasks:
+        task.cancel()
+    await asyncio.gather(*running_tasks, return_exceptions=True)
+    if rpc_session:
+        await rpc_session.close()
+    signing_executor.shutdown(wait=False)
+    password_executor.shutdown(wait=False)
     client.close()
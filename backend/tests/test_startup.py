@@ -0,0 +1,469 @@
+"""
+In-process smoke tests for PIOGOLD ICO Platform - app startup and core admin APIs
+Features tested:
+- Startup hook runs: indexes built, background workers started
+- Liveness endpoint answers once the app is up
+- Payout nonces are reused, never rewound; failed payouts flag their order
+- Verified orders interrupted before payout are resumed; failed payouts can be retried
+- Job leases are renewed while handlers run; one active payout per reference
+- Referral rewards are paid only once their transfer confirms; stale claims are released
+- Admin list limits are validated; racing registrations return the existing user
+- Order tx hashes are normalised; an ingested payment is claimed by one order
+Runs against an in-memory MongoDB (mongomock-motor); skipped when it is not installed.
+"""
+import os
+import sys
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+
+pytest.importorskip("mongomock_motor")
+from mongomock_motor import AsyncMongoMockClient
+from fastapi.testclient import TestClient
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "pioico_test")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import server
+
+
+@pytest.fixture
+def client():
+    """App client with startup/shutdown hooks run against a fresh in-memory database"""
+    server.client = AsyncMongoMockClient()
+    server.db = server.client["pioico_test"]
+    server.PAYMENT_SCANNER_ENABLED = False
+    server.running_tasks.clear()
+    # Shutdown closes the worker pools, so each app session gets fresh ones
+    server.password_executor = ThreadPoolExecutor(max_workers=server.PASSWORD_WORKERS)
+    server.signing_executor = ThreadPoolExecutor(max_workers=server.SIGNING_WORKERS)
+    # Each session runs on its own event loop
+    server.job_wakeup = server.asyncio.Event()
+    server.ico_signer = server.SignerCache()
+    for cache in server.CACHES.values():
+        cache.invalidate()
+    with TestClient(server.app) as test_client:
+        yield test_client
+
+
+def admin_headers(client):
+    response = client.post("/api/admin/setup", json={"username": "admin", "password": "adminpassword", "email": "admin@example.com"})
+    assert response.status_code == 200
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+
+class TestStartup:
+    """Startup hook and background workers"""
+
+    def test_startup_starts_background_workers(self, client):
+        """Startup builds the required indexes and launches the worker tasks"""
+        assert server.running_tasks, "start_background_workers did not run"
+        assert not any(task.done() for task in server.running_tasks)
+        indexes = client.portal.call(server.db.orders.index_information)
+        assert "usdt_tx_hash_unique" in indexes
+        print("✓ Startup ran and background workers are alive")
+
+    def test_liveness(self, client):
+        """Liveness answers while the app is serving"""
+        response = client.get("/api/health/live")
+        assert response.status_code == 200
+        assert response.json()["status"] == "alive"
+        print("✓ Liveness endpoint working")
+
+
+class TestAdminUsers:
+    """Admin user listing"""
+
+    def test_list_users_sorted(self, client):
+        """Users list accepts each supported sort field and rejects others"""
+        headers = admin_headers(client)
+        client.portal.call(server.db.users.insert_one, {
+            "id": "u1", "wallet_address": "0x" + "1" * 40, "referral_code": "ROOT0001", "referrer_id": None,
+            "ancestors": [], "direct_referrals": 0, "total_purchased_usdt": 0, "total_pio_received": 0,
+            "created_at": "2026-01-01T00:00:00+00:00"
+        })
+        for sort_by in server.USER_SORT_FIELDS:
+            response = client.get("/api/admin/users", params={"sort_by": sort_by}, headers=headers)
+            assert response.status_code == 200
+            assert len(response.json()) == 1
+        response = client.get("/api/admin/users", params={"sort_by": "email"}, headers=headers)
+        assert response.status_code == 400
+        print("✓ Admin users list working")
+
+    def test_concurrent_registration_returns_one_user(self, client, monkeypatch):
+        """A registration that loses the race for a wallet returns the user the winner created"""
+        wallet = "0x" + "5" * 40
+        client.portal.call(server.db.users.insert_one, {
+            "id": "root", "wallet_address": "0x" + "1" * 40, "referral_code": "ROOT0001", "referrer_id": None,
+            "ancestors": [], "direct_referrals": 0, "created_at": "2026-01-01T00:00:00+00:00"
+        })
+        get_ancestors = server.get_ancestors
+
+        async def racing_get_ancestors(user):
+            # The competing request inserts the wallet after this one checked for it
+            await server.db.users.insert_one({
+                "id": "winner", "wallet_address": wallet, "referral_code": "WINNER01", "referrer_id": "root",
+                "ancestors": ["root"], "direct_referrals": 0, "created_at": "2026-01-01T00:00:00+00:00"
+            })
+            return await get_ancestors(user)
+
+        monkeypatch.setattr(server, "get_ancestors", racing_get_ancestors)
+        response = client.post("/api/users/register", json={"wallet_address": wallet, "referrer_code": "ROOT0001"})
+        assert response.status_code == 200
+        assert response.json()["id"] == "winner"
+        assert client.portal.call(server.db.users.count_documents, {"wallet_address": wallet}) == 1
+        print("✓ Concurrent registration handled")
+
+    def test_user_details_team_limit_validated(self, client):
+        """User details bounds the team page size like the list endpoints"""
+        headers = admin_headers(client)
+        client.portal.call(server.db.users.insert_one, {
+            "id": "u1", "wallet_address": "0x" + "1" * 40, "referral_code": "ROOT0001", "referrer_id": None,
+            "ancestors": [], "direct_referrals": 0, "total_purchased_usdt": 0, "total_pio_received": 0,
+            "created_at": "2026-01-01T00:00:00+00:00"
+        })
+        for team_limit in [0, server.MAX_PAGE_SIZE + 1]:
+            response = client.get("/api/admin/users/u1/details", params={"team_limit": team_limit}, headers=headers)
+            assert response.status_code == 422
+        response = client.get("/api/admin/users/u1/details", params={"team_limit": 10}, headers=headers)
+        assert response.status_code == 200
+        print("✓ Team limit validated")
+
+    def test_referral_count_from_counter(self, client):
+        """A user's referral summary reports the maintained direct_referrals count, not a capped page"""
+        client.portal.call(server.db.users.insert_one, {
+            "id": "u1", "wallet_address": "0x" + "1" * 40, "referral_code": "ROOT0001", "referrer_id": None,
+            "ancestors": [], "direct_referrals": 150, "created_at": "2026-01-01T00:00:00+00:00"
+        })
+        response = client.get(f"/api/users/{'0x' + '1' * 40}/referrals")
+        assert response.status_code == 200
+        assert response.json()["total_referrals"] == 150
+        print("✓ Referral count from counter")
+
+    def test_list_limit_validated(self, client):
+        """Admin list endpoints reject page sizes outside 1..MAX_PAGE_SIZE"""
+        headers = admin_headers(client)
+        for path in ["/api/admin/users", "/api/admin/orders", "/api/admin/transactions", "/api/admin/referrals"]:
+            for limit in [0, -5, server.MAX_PAGE_SIZE + 1]:
+                response = client.get(path, params={"limit": limit}, headers=headers)
+                assert response.status_code == 422, (path, limit)
+            assert client.get(path, params={"limit": 1}, headers=headers).status_code == 200
+        print("✓ List limits validated")
+
+
+class TestPayouts:
+    """Payout nonce handling and outcome propagation"""
+
+    def test_released_nonce_is_reused_without_rewinding(self, client):
+        """A nonce from a failed send is handed out again; the counter never moves back"""
+        address = "0x" + "9" * 40
+        client.portal.call(server.db.nonce_state.insert_one, {"_id": address, "next_nonce": 10})
+        engine = server.payout_engine
+        assert client.portal.call(engine.allocate_nonce, address) == 10
+        assert client.portal.call(engine.allocate_nonce, address) == 11
+        client.portal.call(engine.release_nonce, address, 10)
+        assert client.portal.call(engine.allocate_nonce, address) == 10
+        assert client.portal.call(engine.allocate_nonce, address) == 12
+        print("✓ Released nonces reused in order")
+
+    def test_nonce_too_low_resyncs_and_next_payout_succeeds(self, client, monkeypatch):
+        """A stale nonce is not handed out again; the counter jumps to the chain's pending count"""
+        account = server.Account.from_key("0x" + "4c" * 32)
+        engine = server.payout_engine
+        client.portal.call(server.db.nonce_state.insert_one, {"_id": account.address, "next_nonce": 5, "free": [3]})
+        broadcasts = []
+
+        async def send_raw_transaction(raw):
+            broadcasts.append(raw)
+            if len(broadcasts) == 1:
+                raise ValueError({"code": -32000, "message": "nonce too low"})
+            return b""
+
+        async def get_transaction(tx_hash):
+            raise server.TransactionNotFound(tx_hash)
+
+        async def get_transaction_count(address, block):
+            return 9
+
+        async def current_gas_price():
+            return 10**9
+
+        monkeypatch.setattr(server.piogold_w3.eth, "send_raw_transaction", send_raw_transaction)
+        monkeypatch.setattr(server.piogold_w3.eth, "get_transaction", get_transaction)
+        monkeypatch.setattr(server.piogold_w3.eth, "get_transaction_count", get_transaction_count)
+        monkeypatch.setattr(engine, "current_gas_price", current_gas_price)
+        with pytest.raises(ValueError):
+            client.portal.call(engine.submit, account, "0x" + "2" * 40, 1, "pio_transfer", "o4")
+        state = client.portal.call(server.db.nonce_state.find_one, {"_id": account.address})
+        assert state["next_nonce"] == 9
+        assert state["free"] == []
+        client.portal.call(engine.submit, account, "0x" + "2" * 40, 1, "pio_transfer", "o5")
+        payout = client.portal.call(server.db.payouts.find_one, {"reference": "o5"})
+        assert payout["nonce"] == 9
+        print("✓ Nonce too low resyncs the counter")
+
+    def test_signer_built_once_for_concurrent_callers(self, client):
+        """Concurrent first lookups share one key derivation"""
+        encrypted = server.encrypt_private_key("0x" + "4c" * 32)
+
+        async def lookup_many():
+            return await server.asyncio.gather(*[server.ico_signer.get(encrypted) for _ in range(8)])
+
+        accounts = client.portal.call(lookup_many)
+        assert len({account.address for account in accounts}) == 1
+        assert server.ico_signer.builds == 1
+        print("✓ Signer derived once")
+
+    def test_dropped_payout_flags_order(self, client):
+        """A dropped PIO transfer moves its completed order to pio_transfer_failed and reverses stats"""
+        client.portal.call(server.db.orders.insert_one, {
+            "id": "o1", "user_id": "u1", "status": "completed", "usdt_amount": 100.0, "total_pio": 2.0,
+            "pio_tx_hash": "0xabc"
+        })
+        client.portal.call(server.db.users.insert_one, {"id": "u1", "total_purchased_usdt": 100.0, "total_pio_received": 2.0})
+        client.portal.call(server.db.referrals.insert_one, {"id": "r1", "order_id": "o1", "status": "pending", "reward_pio": 0.1})
+        payout = {"id": "p1", "kind": "pio_transfer", "reference": "o1", "tx_hashes": ["0xabc"]}
+        client.portal.call(server.payout_engine.record_outcome, payout, "dropped")
+        order = client.portal.call(server.db.orders.find_one, {"id": "o1"})
+        assert order["status"] == "pio_transfer_failed"
+        user = client.portal.call(server.db.users.find_one, {"id": "u1"})
+        assert user["total_pio_received"] == 0
+        referral = client.portal.call(server.db.referrals.find_one, {"id": "r1"})
+        assert referral["status"] == "rejected"
+        print("✓ Dropped payout flags its order")
+
+
+class TestOrderRecovery:
+    """Orders interrupted between verification and payout"""
+
+    ORDER = {
+        "id": "o2", "user_id": "u2", "status": "verified", "usdt_amount": 100.0, "total_pio": 2.0, "gold_price": 50.0,
+        "wallet_address": "0x" + "2" * 40, "usdt_tx_hash": "0x" + "b" * 64, "created_at": "2026-01-01T00:00:00+00:00"
+    }
+
+    def test_verified_order_is_requeued_and_paid(self, client, monkeypatch):
+        """Startup recovery re-runs a finished job for a verified order, which then pays it once"""
+        sent = []
+
+        async def fake_send(recipient, amount, reference=None, kind="pio_transfer"):
+            sent.append(reference)
+            return {"success": True, "tx_hash": "0xpio"}
+
+        monkeypatch.setattr(server, "send_pio_native", fake_send)
+        client.portal.call(server.db.orders.insert_one, dict(self.ORDER))
+        client.portal.call(server.db.jobs.insert_one, {"id": "process_order:o2", "type": "process_order", "status": "done"})
+        client.portal.call(server.recover_pending_orders)
+        job = client.portal.call(server.db.jobs.find_one, {"id": "process_order:o2"})
+        assert job["status"] in ("queued", "running", "done")
+        client.portal.call(server.process_order, "o2", 0)
+        client.portal.call(server.process_order, "o2", 0)
+        order = client.portal.call(server.db.orders.find_one, {"id": "o2"})
+        assert order["status"] == "completed"
+        assert order["pio_tx_hash"] == "0xpio"
+        assert sent == ["o2"]
+        print("✓ Verified order resumed and paid once")
+
+    def test_verified_order_reuses_submitted_payout(self, client, monkeypatch):
+        """A payout already recorded for the order is not sent again"""
+        async def fake_send(*args, **kwargs):
+            raise AssertionError("PIO sent twice")
+
+        monkeypatch.setattr(server, "send_pio_native", fake_send)
+        client.portal.call(server.db.orders.insert_one, dict(self.ORDER))
+        client.portal.call(server.db.payouts.insert_one, {
+            "id": "p2", "kind": "pio_transfer", "reference": "o2", "tx_hash": "0xearlier", "status": "submitted"
+        })
+        client.portal.call(server.process_order, "o2", 0)
+        order = client.portal.call(server.db.orders.find_one, {"id": "o2"})
+        assert order["status"] == "completed"
+        assert order["pio_tx_hash"] == "0xearlier"
+        print("✓ Existing payout reused")
+
+    def test_retry_failed_payout(self, client):
+        """Admin retry puts a failed order back to verified and queues its job"""
+        headers = admin_headers(client)
+        client.portal.call(server.db.orders.insert_one, dict(self.ORDER, status="pio_transfer_failed", error="boom"))
+        response = client.post("/api/admin/orders/o2/retry-payout", headers=headers)
+        assert response.status_code == 200
+        # The job worker may already have picked the order up again
+        order = client.portal.call(server.db.orders.find_one, {"id": "o2"})
+        assert order["status"] != "pio_transfer_failed" or order["error"] != "boom"
+        assert client.portal.call(server.db.jobs.find_one, {"id": "process_order:o2"}) is not None
+        response = client.post("/api/admin/orders/missing/retry-payout", headers=headers)
+        assert response.status_code == 404
+        print("✓ Failed payout retry working")
+
+
+class TestReferralPayouts:
+    """Bulk referral payouts settle on the payout outcome"""
+
+    def test_referral_claims_follow_payout(self, client, monkeypatch):
+        """Missing wallets are released, paid waits for confirmation, dropped transfers are released"""
+        async def fake_send(recipient, amount, reference=None, kind="pio_transfer"):
+            return {"success": True, "tx_hash": "0x" + recipient[2:4]}
+
+        monkeypatch.setattr(server, "send_pio_native", fake_send)
+        client.portal.call(server.db.referrals.insert_many, [
+            {"id": f"r{i}", "referrer_id": referrer, "reward_pio": 1.0, "status": "paying", "payout_batch": "b1",
+             "claimed_from": "approved", "updated_at": "2026-01-01T00:00:00+00:00"}
+            for i, referrer in enumerate(["u1", "u2", "ghost"])
+        ])
+        groups = [{"_id": referrer, "count": 1, "reward_pio": 1.0} for referrer in ["u1", "u2", "ghost"]]
+        wallets = {"u1": "0x" + "1" * 40, "u2": "0x" + "2" * 40}
+        transfers = client.portal.call(server.pay_referral_batch, "b1", groups, wallets)
+        assert [t.get("error") for t in transfers] == [None, None, "Referrer wallet not found"]
+
+        def status(referral_id):
+            return client.portal.call(server.db.referrals.find_one, {"id": referral_id})["status"]
+
+        assert [status("r0"), status("r1"), status("r2")] == ["paying", "paying", "approved"]
+        client.portal.call(server.payout_engine.record_outcome,
+                           {"kind": "referral_payout", "reference": "b1:u1", "tx_hash": "0x11"}, "confirmed")
+        client.portal.call(server.payout_engine.record_outcome,
+                           {"kind": "referral_payout", "reference": "b1:u2", "tx_hash": "0x22"}, "dropped")
+        assert [status("r0"), status("r1")] == ["paid", "approved"]
+        print("✓ Referral payouts settle on outcome")
+
+    def test_paying_referral_status_locked(self, client):
+        """Admins cannot change a referral while its bulk payout is in flight"""
+        headers = admin_headers(client)
+        client.portal.call(server.db.referrals.insert_one, {
+            "id": "r7", "referrer_id": "u1", "reward_pio": 1.0, "status": "paying", "payout_batch": "b7",
+            "claimed_from": "approved"
+        })
+        for status in ["approved", "paid", "rejected"]:
+            response = client.put("/api/admin/referrals/r7", json={"status": status}, headers=headers)
+            assert response.status_code == 409
+        assert client.portal.call(server.db.referrals.find_one, {"id": "r7"})["status"] == "paying"
+        assert client.put("/api/admin/referrals/missing", json={"status": "paid"}, headers=headers).status_code == 404
+        print("✓ Paying referral locked")
+
+    def test_stale_claim_released(self, client):
+        """A claim whose transfer was never submitted goes back to its previous status"""
+        client.portal.call(server.db.referrals.insert_one, {
+            "id": "r9", "referrer_id": "u1", "reward_pio": 1.0, "status": "paying", "payout_batch": "dead",
+            "claimed_from": "pending", "updated_at": "2020-01-01T00:00:00+00:00"
+        })
+        client.portal.call(server.release_stale_referral_claims)
+        referral = client.portal.call(server.db.referrals.find_one, {"id": "r9"})
+        assert referral["status"] == "pending"
+        assert "payout_batch" not in referral
+        print("✓ Stale referral claim released")
+
+
+class TestJobLeases:
+    """Job leases and payout reservations under slow handlers"""
+
+    def test_lease_renewed_while_handler_runs(self, client, monkeypatch):
+        """A handler running past the visibility timeout is not redelivered"""
+        monkeypatch.setattr(server, "JOB_VISIBILITY_TIMEOUT", 0.3)
+        monkeypatch.setattr(server, "JOB_IDLE_POLL", 0.05)
+
+        async def slow_handler(job):
+            await server.asyncio.sleep(1)
+            return None
+
+        monkeypatch.setitem(server.JOB_HANDLERS, "slow", slow_handler)
+        client.portal.call(server.enqueue_job, "slow", "k1", {})
+        client.portal.call(server.asyncio.sleep, 1.5)
+        job = client.portal.call(server.db.jobs.find_one, {"id": "slow:k1"})
+        assert job["status"] == "done"
+        assert job["attempts"] == 1
+        print("✓ Job lease renewed while running")
+
+    def test_second_payout_for_reference_reuses_first(self, client):
+        """Only one active payout can exist per (reference, kind); a second submit gets its hash"""
+        account = server.Account.from_key("0x" + "4c" * 32)
+        client.portal.call(server.db.nonce_state.insert_one, {"_id": account.address, "next_nonce": 5})
+        client.portal.call(server.db.payouts.insert_one, {
+            "id": "p3", "kind": "pio_transfer", "reference": "o3", "tx_hash": "0xfirst", "status": "submitted",
+            "active": True, "nonce": 4
+        })
+        tx_hash = client.portal.call(server.payout_engine.submit_at, account, 5, 10**9, "0x" + "2" * 40, 1, "pio_transfer", "o3")
+        assert tx_hash == "0xfirst"
+        assert client.portal.call(server.db.payouts.count_documents, {"reference": "o3"}) == 1
+        state = client.portal.call(server.db.nonce_state.find_one, {"_id": account.address})
+        assert state["free"] == [5]
+        print("✓ Payout reservation is unique per reference")
+
+
+class TestOrderTxHash:
+    """One USDT transfer backs at most one order"""
+
+    WALLET = "0x" + "7" * 40
+    TX_HASH = "0x" + "ab" * 32
+
+    def configure_ico_wallet(self, client):
+        headers = admin_headers(client)
+        response = client.put("/api/admin/settings", json={"ico_wallet_address": self.WALLET}, headers=headers)
+        assert response.status_code == 200
+
+    def test_tx_hash_validated_and_lowercased(self, client):
+        """Hashes differing only in case resolve to one order; malformed hashes are rejected"""
+        self.configure_ico_wallet(client)
+        order = {"wallet_address": "0x" + "2" * 40, "usdt_amount": 100}
+        first = client.post("/api/orders/create", json=dict(order, tx_hash=self.TX_HASH.upper().replace("0X", "0x")))
+        assert first.status_code == 200
+        second = client.post("/api/orders/create", json=dict(order, tx_hash=self.TX_HASH))
+        assert second.status_code == 200
+        assert second.json()["order_id"] == first.json()["order_id"]
+        stored = client.portal.call(server.db.orders.find_one, {"id": first.json()["order_id"]})
+        assert stored["usdt_tx_hash"] == self.TX_HASH
+        for bad in ["0x1234", "ab" * 32, "0x" + "zz" * 32]:
+            assert client.post("/api/orders/create", json=dict(order, tx_hash=bad)).status_code == 422
+        print("✓ Order tx hash normalised")
+
+    def insert_order_with_claimed_payment(self, client):
+        self.configure_ico_wallet(client)
+        client.portal.call(server.db.orders.insert_one, {
+            "id": "o6", "user_id": "u6", "status": "pending_verification", "usdt_amount": 100.0, "total_pio": 2.0,
+            "wallet_address": "0x" + "2" * 40, "usdt_tx_hash": self.TX_HASH, "created_at": "2026-01-01T00:00:00+00:00"
+        })
+        client.portal.call(server.db.usdt_payments.insert_one, {
+            "tx_hash": self.TX_HASH, "log_index": 0, "block_number": 1, "from_address": "0x" + "2" * 40,
+            "to_address": self.WALLET, "amount_wei": str(100 * 10**server.USDT_DECIMALS), "order_id": "other"
+        })
+
+    def test_claimed_payment_fails_second_order(self, client):
+        """An ingested transfer already claimed by another order fails verification"""
+        self.insert_order_with_claimed_payment(client)
+        client.portal.call(server.process_order, "o6", 100)
+        order = client.portal.call(server.db.orders.find_one, {"id": "o6"})
+        assert order["status"] == "verification_failed"
+        assert order["error"] == "Payment already used by another order"
+        print("✓ Claimed payment cannot pay twice")
+
+    def test_payment_verification_is_timed(self, client):
+        """Verifying an order's payment records its latency in the operation histogram"""
+        from prometheus_client import REGISTRY
+
+        def verifications():
+            return REGISTRY.get_sample_value(
+                "pioico_operation_duration_seconds_count", {"operation": "verify_usdt_payment"}
+            ) or 0
+
+        self.insert_order_with_claimed_payment(client)
+        before = verifications()
+        client.portal.call(server.process_order, "o6", 100)
+        assert verifications() == before + 1
+        print("✓ Payment verification timed")
+
+
+class TestClientIp:
+    """Client address used by the login throttle"""
+
+    @staticmethod
+    def request(peer):
+        return server.Request({"type": "http", "client": (peer, 1234), "headers": [(b"x-real-ip", b"203.0.113.9")]})
+
+    def test_proxy_header_ignored_by_default(self):
+        """X-Real-IP is not trusted unless enabled"""
+        assert server.client_ip(self.request("127.0.0.1")) == "127.0.0.1"
+        print("✓ Proxy header ignored by default")
+
+    def test_proxy_header_only_from_trusted_proxy(self, monkeypatch):
+        """With proxy headers enabled, only a trusted peer may supply the client address"""
+        monkeypatch.setattr(server, "TRUST_PROXY_HEADERS", True)
+        assert server.client_ip(self.request("127.0.0.1")) == "203.0.113.9"
+        assert server.client_ip(self.request("198.51.100.7")) == "198.51.100.7"
+        print("✓ Proxy header honoured from trusted proxies only")
@@ -77,6 +77,10 @@ export const AdminProvider = ({ children }) => {
     
     // Logout
     const logout = () => {
+        if (token) {
+            // Revoke the session server-side; the local token is dropped either way
+            authAxios().post('/admin/logout').catch(() => {});
+        }
         localStorage.removeItem('admin_token');
         setToken(null);
         setIsAuthenticated(false);